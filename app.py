@@ -4,13 +4,16 @@ N_m3u8DL-RE DRM Processor with API-triggered Processing
 Allows triggering file processing via HTTP requests
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 import os
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
+import anyio
 import subprocess
 import asyncio
 from datetime import datetime
@@ -18,6 +21,33 @@ from typing import Optional, Dict, List
 import uuid
 import uvicorn
 import json
+import time
+import heapq
+import hashlib
+import math
+import struct
+import tarfile
+import zlib
+import base64
+import re
+import shutil
+import itertools
+import bisect
+import threading
+import logging
+import logging.handlers
+import queue
+import random
+import atexit
+import contextvars
+import collections
+import sys
+import hmac
+import tracemalloc
+import signal
+from contextlib import contextmanager
+import aiohttp
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
 
@@ -33,16 +63,680 @@ app.add_middleware(
 )
 
 # Paths
-BASE_DIR = Path("/app")
+BASE_DIR = Path(os.environ.get("APP_BASE_DIR", "/app"))
 STREAM_DIR = BASE_DIR / "stream"
 STREAM_DIR.mkdir(parents=True, exist_ok=True)
+META_DIR = STREAM_DIR / ".meta"  # Derived data cached next to the outputs
+
+# External tools (overridable, e.g. with the fakes in benchmarks/fake_tools)
+N_M3U8DL_RE_PATH = os.environ.get("N_M3U8DL_RE_PATH", "/usr/local/bin/N_m3u8DL-RE")
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "/usr/bin/ffmpeg")
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "/usr/bin/ffprobe")
+MP4DECRYPT_PATH = os.environ.get("MP4DECRYPT_PATH", "/usr/local/bin/mp4decrypt")
+GDRIVE_UPLOAD = os.environ.get("GDRIVE_UPLOAD", "1") == "1"  # Upload finished MP4s to Google Drive
+
+# Logging: one JSON object per line, written by a background listener thread so
+# a slow stdout never blocks the event loop
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0.01"))  # Share of hot-path debug logs kept
+
+# Job the current task works on; asyncio tasks and to_thread calls inherit it
+current_job_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("job_id", default=None)
+# Active trace span (see Span below), propagated the same way
+current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("span", default=None)
+
+class JsonFormatter(logging.Formatter):
+    """Render a record as a JSON line. Structured fields are passed as extra={"fields": {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        job_id = getattr(record, "job_id", None)
+        if job_id:
+            entry["job_id"] = job_id
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class JobContextFilter(logging.Filter):
+    """Stamp records with the job id of the task that logged them."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = current_job_id.get()
+        span = current_span.get()
+        if span is not None:
+            record.trace_id = span.trace_id
+        return True
+
+def setup_logging() -> logging.Logger:
+    # Records are formatted in the calling task (so the job context is right)
+    # and handed to the listener thread through an unbounded queue
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(JobContextFilter())
+    queue_handler.setFormatter(JsonFormatter())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    service_logger = logging.getLogger("processor")
+    service_logger.setLevel(LOG_LEVEL)
+    service_logger.addHandler(queue_handler)
+    service_logger.propagate = False
+    return service_logger
+
+logger = setup_logging()
+
+def log_sampled(message: str, **fields):
+    """Debug log for hot paths, kept for LOG_DEBUG_SAMPLE_RATE of the calls."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_DEBUG_SAMPLE_RATE:
+        logger.debug(message, extra={"fields": {**fields, "sample_rate": LOG_DEBUG_SAMPLE_RATE}})
 
 # Job tracking
 active_jobs: Dict[str, dict] = {}
 completed_jobs: Dict[str, dict] = {}
 
-# Mount static files directory
-app.mount("/stream", StaticFiles(directory=str(STREAM_DIR)), name="stream")
+# Download thread tuning
+DOWNLOAD_THREAD_BUDGET = int(os.environ.get("DOWNLOAD_THREAD_BUDGET", "32"))  # Threads shared by all running downloads
+DEFAULT_DOWNLOAD_THREADS = int(os.environ.get("DEFAULT_DOWNLOAD_THREADS", "8"))  # Starting point for unseen hosts
+MIN_DOWNLOAD_THREADS = int(os.environ.get("MIN_DOWNLOAD_THREADS", "2"))
+MAX_THREADS_PER_HOST = int(os.environ.get("MAX_THREADS_PER_HOST", "16"))  # Never open more than this against one origin
+TUNING_LOG_FILE = BASE_DIR / "download_tuning.jsonl"
+
+# Per-host download history used by the thread tuner
+host_stats: Dict[str, dict] = {}
+
+# Throughput model behind job duration predictions. Finished jobs update
+# rolling averages keyed by (host, bitrate class); None in a key means
+# "any", so unseen hosts or classes fall back to coarser entries.
+ETA_MODEL_ALPHA = float(os.environ.get("ETA_MODEL_ALPHA", "0.3"))  # Weight of the newest job in the averages
+ETA_REFRESH_SECONDS = float(os.environ.get("ETA_REFRESH_SECONDS", "1"))  # Reuse computed queue ETAs this long
+BITRATE_CLASSES = ((2, "under_2mbps"), (6, "2_6mbps"), (12, "6_12mbps"), (math.inf, "over_12mbps"))
+throughput_model: Dict[tuple, dict] = {}
+queue_eta_cache: dict = {"computed": 0.0, "etas": {}}
+
+# Every change to a job record bumps the store version; records carry the
+# version of their last change so clients can sync incrementally
+job_store_version = 0
+
+def bump_job_store_version() -> int:
+    """Advance the job store version and return the new value."""
+    global job_store_version
+    job_store_version += 1
+    return job_store_version
+
+class JobRecord(dict):
+    """Job dict that stamps itself with the store version whenever it changes."""
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        super().__setitem__("revision", bump_job_store_version())
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        super().__setitem__("revision", bump_job_store_version())
+
+# The file index has its own version, bumped whenever a job publishes an output
+file_index_version = 0
+
+def bump_file_index_version() -> int:
+    """Advance the file index version after outputs were added or changed."""
+    global file_index_version
+    file_index_version += 1
+    return file_index_version
+
+# Serialized responses of the metadata endpoints, reused until their version changes
+INSTANCE_ID = uuid.uuid4().hex[:8]  # Keeps ETags from colliding across restarts
+response_cache: Dict[str, dict] = {}
+
+# Batches submitted via /process/batch
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "1000"))
+batches: Dict[str, dict] = {}
+
+# Request fingerprint -> most recent job for it, used to coalesce duplicate submissions
+job_fingerprints: Dict[str, str] = {}
+
+# Signed-URL query parameters that change per request but not what gets downloaded
+FINGERPRINT_IGNORED_PARAMS = {
+    "token", "auth", "signature", "sig", "expires", "exp", "policy",
+    "key-pair-id", "hdnts", "hdnea", "hmac"
+}
+
+# Upper bound on ids per POST /jobs/status call
+MAX_STATUS_QUERY_IDS = int(os.environ.get("MAX_STATUS_QUERY_IDS", "10000"))
+
+# Statuses after which a job no longer changes
+FINISHED_STATUSES = ("completed", "error", "cancelled")
+
+# Job scheduling
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "4"))
+MAX_JOBS_PER_HOST = int(os.environ.get("MAX_JOBS_PER_HOST", "2"))  # Concurrent jobs against one origin host
+SCHEDULER_POLICY = os.environ.get("SCHEDULER_POLICY", "fifo")  # "fifo" or "sejf" (shortest expected job first)
+
+# Queued jobs are kept per origin host so a saturated host never blocks the others
+host_queues: Dict[str, list] = {}  # host -> heap of (sort_key, sequence, job_id)
+queued_requests: Dict[str, "ProcessRequest"] = {}
+running_per_host: Dict[str, int] = {}
+running_tasks: Dict[str, asyncio.Task] = {}
+job_sequence = itertools.count()
+
+# Ingress bandwidth budget
+INGRESS_BUDGET_MB_PER_S = float(os.environ.get("INGRESS_BUDGET_MB_PER_S", "0"))  # 0 disables the budget
+BANDWIDTH_POLICY = os.environ.get("BANDWIDTH_POLICY", "fair")  # "fair" or "weighted" (by request priority)
+MIN_JOB_BANDWIDTH_MB_PER_S = float(os.environ.get("MIN_JOB_BANDWIDTH_MB_PER_S", "0.5"))  # Lowered if the budget can't give every slot this much
+
+# Bandwidth shares of the downloads currently running. Fixed at launch (--max-speed),
+# so budget a download frees stays idle until the next one starts
+bandwidth_allocations: Dict[str, dict] = {}
+
+# File serving
+SERVE_CHUNK_SIZE = int(os.environ.get("SERVE_CHUNK_SIZE", str(1024 * 1024)))
+MAX_RANGES_PER_REQUEST = 16  # More ranges than this are answered with the whole file
+
+# Egress shaping for file serving (0 disables a limit)
+EGRESS_GLOBAL_MB_PER_S = float(os.environ.get("EGRESS_GLOBAL_MB_PER_S", "0"))
+EGRESS_CLIENT_MB_PER_S = float(os.environ.get("EGRESS_CLIENT_MB_PER_S", "0"))
+EGRESS_BURST_SECONDS = float(os.environ.get("EGRESS_BURST_SECONDS", "2"))  # Bucket size, in seconds of rate
+EGRESS_MAX_WAIT_SECONDS = float(os.environ.get("EGRESS_MAX_WAIT_SECONDS", "10"))  # Longer backlogs get 429
+MAX_CONNECTIONS_PER_CLIENT = int(os.environ.get("MAX_CONNECTIONS_PER_CLIENT", "0"))
+# Only enable behind a proxy that appends to X-Forwarded-For (HF Spaces does);
+# otherwise clients could pick their own identity and dodge the limits
+TRUST_PROXY_HEADERS = os.environ.get("TRUST_PROXY_HEADERS", "0") == "1"
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1"))  # Proxies in front of the app that append to it
+
+# Output checksums (SHA-256 plus the CRC-32 that ZIP bundles need), keyed by filename.
+# Default MP4s are hashed while they are written; other outputs cost a full read-back
+CHECKSUM_REREAD = os.environ.get("CHECKSUM_REREAD", "0") == "1"  # Also hash live/hls MP4s and MKV fallbacks
+file_checksums: Dict[str, dict] = {}
+
+# Media probing of finished outputs
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY", "2"))
+probe_semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+probe_cache: Dict[str, dict] = {}  # filename -> probe result, valid while inode and mtime match
+probe_inflight: Dict[tuple, asyncio.Task] = {}
+background_tasks: set = set()  # Keeps fire-and-forget tasks alive until they finish
+
+# Thumbnail and seek-preview sprite generation
+GENERATE_PREVIEWS = os.environ.get("GENERATE_PREVIEWS", "0") == "1"  # Default for jobs that don't say
+PREVIEW_CONCURRENCY = int(os.environ.get("PREVIEW_CONCURRENCY", "1"))
+PREVIEW_INTERVAL = float(os.environ.get("PREVIEW_INTERVAL", "10"))  # Seconds between thumbnails
+PREVIEW_WIDTH = int(os.environ.get("PREVIEW_WIDTH", "160"))
+PREVIEW_TILE = (10, 10)  # Sprite sheet columns x rows
+preview_semaphore = asyncio.Semaphore(PREVIEW_CONCURRENCY)
+preview_inflight: Dict[tuple, asyncio.Task] = {}
+PREVIEW_ASSET_PATTERN = re.compile(r"^(thumb_\d{4}\.jpg|sprite_\d{3}\.jpg|sprite\.vtt)$")
+
+# Streaming ZIP/TAR bundles
+MAX_BUNDLE_FILES = int(os.environ.get("MAX_BUNDLE_FILES", "1000"))
+crc32_cache: Dict[tuple, int] = {}  # (inode, size, mtime_ns) -> CRC-32, needed for ZIP directories
+
+# Progressive (/live) serving of outputs that are still being muxed
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", "0.25"))
+LIVE_IDLE_TIMEOUT = float(os.environ.get("LIVE_IDLE_TIMEOUT", "600"))  # Give up after this long without new bytes once the mux has started
+
+# Byte-range HLS playlists over finished fragmented MP4s
+HLS_SEGMENT_SECONDS = float(os.environ.get("HLS_SEGMENT_SECONDS", "6"))
+
+# Metrics registry exposed at /metrics in the Prometheus text format.
+# Updates are a dict lookup and an add, so they can sit on hot paths.
+EVENT_LOOP_LAG_INTERVAL = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+metrics_registry: list = []
+
+def format_metric_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_metric_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """Base for registry entries; `labels` are the label names, values are keyed by label tuples."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        metrics_registry.append(self)
+
+    def samples(self) -> Dict[tuple, float]:
+        return self.values
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.samples().items()):
+            lines.append(f"{self.name}{format_metric_labels(self.labels, label_values)} {format_metric_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """A gauge that is either set directly or computed by `collect` at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), collect=None):
+        super().__init__(name, help_text, labels)
+        self.collect = collect
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def samples(self) -> Dict[tuple, float]:
+        return self.collect() if self.collect is not None else self.values
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[tuple, list] = {}  # labels -> [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{format_metric_value(bound)}"'
+                lines.append(f"{self.name}_bucket{format_metric_labels(self.labels, label_values, le)} {cumulative}")
+            label_text = format_metric_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{label_text} {format_metric_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+# Job statuses that mean a pipeline stage is running
+RUNNING_STAGES = {"processing": "download", "converting": "remux", "uploading_to_gdrive": "publish"}
+STAGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+def count_running_stages() -> Dict[tuple, float]:
+    counts = {(stage,): 0 for stage in list(RUNNING_STAGES.values()) + ["probe", "previews"]}
+    for job in active_jobs.values():
+        stage = RUNNING_STAGES.get(job.get("status"))
+        if stage is not None:
+            counts[(stage,)] += 1
+    counts[("probe",)] = len(probe_inflight)
+    counts[("previews",)] = len(preview_inflight)
+    return counts
+
+metric_jobs_queued = Gauge("processor_jobs_queued", "Jobs waiting for a scheduler slot",
+                           collect=lambda: {(): len(queued_requests)})
+metric_jobs_running = Gauge("processor_jobs_running", "Jobs currently in each pipeline stage",
+                            labels=("stage",), collect=count_running_stages)
+metric_jobs_submitted = Counter("processor_jobs_submitted_total", "Jobs accepted for processing")
+metric_jobs_deduplicated = Counter("processor_jobs_deduplicated_total", "Submissions answered with an existing job")
+metric_jobs_finished = Counter("processor_jobs_finished_total", "Jobs that reached a final status", labels=("status",))
+metric_job_failures = Counter("processor_job_failures_total", "Pipeline failures by reason", labels=("reason",))
+metric_stage_duration = Histogram("processor_stage_duration_seconds", "Wall time of pipeline stages",
+                                  STAGE_BUCKETS, labels=("stage",))
+metric_downloaded_bytes = Counter("processor_downloaded_bytes_total", "Bytes produced by N_m3u8DL-RE downloads")
+metric_remuxed_bytes = Counter("processor_remuxed_bytes_total", "Bytes written by the MP4 remux")
+metric_served_bytes = Counter("processor_served_bytes_total", "Bytes sent to clients", labels=("route",))
+metric_serve_duration = Histogram("processor_serve_duration_seconds", "Duration of file responses",
+                                  (0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300, 1800), labels=("status",))
+metric_egress_connections = Gauge("processor_egress_connections", "File transfers in progress",
+                                  collect=lambda: {(): sum(client_connections.values())})
+metric_egress_rejections = Counter("processor_egress_rejections_total", "Transfers refused with 429", labels=("reason",))
+metric_child_cpu = Counter("processor_child_cpu_seconds_total", "CPU time of child processes",
+                           labels=("stage", "mode"))
+metric_child_io = Counter("processor_child_io_bytes_total", "Storage I/O of child processes",
+                          labels=("stage", "direction"))
+metric_child_peak_rss = Histogram("processor_child_peak_rss_bytes", "Peak RSS of child processes",
+                                  tuple(2 ** power * 1024 * 1024 for power in range(4, 14)), labels=("stage",))
+metric_event_loop_lag = Gauge("processor_event_loop_lag_seconds", "Event loop lag at the last check")
+metric_event_loop_lag_histogram = Histogram("processor_event_loop_lag_distribution_seconds", "Event loop lag",
+                                            (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+async def monitor_event_loop_lag():
+    """Measure how late the loop wakes up from a fixed sleep."""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - started - EVENT_LOOP_LAG_INTERVAL)
+        metric_event_loop_lag.set(lag)
+        metric_event_loop_lag_histogram.observe(lag)
+
+# Per-stage latency over a sliding window, for /stats. Each stage keeps a ring of
+# fixed-bucket histograms (one per slot of the window); quantiles come from
+# merging the live slots, so memory and query cost don't grow with job count.
+STATS_WINDOW_SECONDS = float(os.environ.get("STATS_WINDOW_SECONDS", "3600"))
+STATS_WINDOW_SLOTS = 12
+# Log-spaced bounds from 10 ms to a day, ~5% apart (bounds the quantile error)
+STATS_BUCKETS = tuple(0.01 * 1.05 ** i for i in range(int(math.log(86400 / 0.01, 1.05)) + 2))
+JOB_STAGES = ("queue", "download", "remux", "post_process", "publish", "total")
+
+class SlidingHistogram:
+    """Streaming histogram over the last STATS_WINDOW_SECONDS."""
+
+    def __init__(self):
+        self.slot_seconds = STATS_WINDOW_SECONDS / STATS_WINDOW_SLOTS
+        self.slots = [None] * STATS_WINDOW_SLOTS  # [epoch, counts, sum, max]
+
+    def observe(self, value: float):
+        epoch = int(time.monotonic() // self.slot_seconds)
+        slot = self.slots[epoch % STATS_WINDOW_SLOTS]
+        if slot is None or slot[0] != epoch:
+            slot = self.slots[epoch % STATS_WINDOW_SLOTS] = [epoch, [0] * (len(STATS_BUCKETS) + 1), 0.0, 0.0]
+        slot[1][bisect.bisect_left(STATS_BUCKETS, value)] += 1
+        slot[2] += value
+        slot[3] = max(slot[3], value)
+
+    def summary(self, quantiles=(0.5, 0.95, 0.99)) -> dict:
+        oldest = int(time.monotonic() // self.slot_seconds) - STATS_WINDOW_SLOTS + 1
+        live = [slot for slot in self.slots if slot is not None and slot[0] >= oldest]
+        counts = [sum(column) for column in zip(*(slot[1] for slot in live))]
+        total = sum(counts)
+        if total == 0:
+            return {"count": 0}
+
+        largest = max(slot[3] for slot in live)
+        result = {
+            "count": total,
+            "mean": round(sum(slot[2] for slot in live) / total, 3),
+            "max": round(largest, 3)
+        }
+        for quantile in quantiles:
+            rank = quantile * total
+            cumulative = 0
+            for index, count in enumerate(counts):
+                cumulative += count
+                if cumulative >= rank:
+                    break
+            # Upper bucket bound, never beyond the largest value seen
+            bound = STATS_BUCKETS[index] if index < len(STATS_BUCKETS) else largest
+            result[f"p{round(quantile * 100):g}"] = round(min(bound, largest), 3)
+        return result
+
+stage_windows: Dict[str, SlidingHistogram] = {}
+
+def observe_stage(stage: str, seconds: float):
+    """Feed a stage duration to /metrics and the /stats window."""
+    metric_stage_duration.observe(seconds, (stage,))
+    window = stage_windows.get(stage)
+    if window is None:
+        window = stage_windows[stage] = SlidingHistogram()
+    window.observe(seconds)
+
+def begin_stage(job: dict, stage: str):
+    """Record the monotonic start of a pipeline stage on the job."""
+    timings = job["timings"]
+    timings["stages"][stage] = {"start": round(time.monotonic(), 6), "end": None, "seconds": None}
+    job["timings"] = timings  # Reassigned so the job revision moves
+
+    span = Span(stage, parent=job_spans.get(job["job_id"]))
+    stage_spans[(job["job_id"], stage)] = span
+    if current_job_id.get() == job["job_id"]:
+        # Inside the job's own task, children (subprocesses, uploads) nest under the stage
+        current_span.set(span)
+
+def end_stage(job: dict, stage: str, record: bool = True) -> float:
+    """Close a stage on the job and return its duration; only successful stages feed the stats."""
+    timings = job["timings"]
+    entry = timings["stages"].get(stage)
+    if entry is None or entry["end"] is not None:
+        return 0.0
+    now = time.monotonic()
+    seconds = now - entry["start"]
+    entry["end"] = round(now, 6)
+    entry["seconds"] = round(seconds, 6)
+    job["timings"] = timings
+    if record:
+        observe_stage(stage, seconds)
+
+    span = stage_spans.pop((job["job_id"], stage), None)
+    if span is not None:
+        if not record:
+            span.set_status_error(f"{stage} did not complete")
+        span.end()
+        if current_job_id.get() == job["job_id"]:
+            current_span.set(job_spans.get(job["job_id"]))
+    return seconds
+
+def finish_job_timings(job: dict):
+    """Close whatever stage a finished job was in and record its end-to-end time."""
+    timings = job["timings"]
+    for stage, entry in list(timings["stages"].items()):
+        if entry["end"] is None:
+            end_stage(job, stage, record=False)
+    seconds = time.monotonic() - timings["submitted"]
+    timings["total_seconds"] = round(seconds, 6)
+    job["timings"] = timings
+    if job["status"] == "completed":
+        observe_stage("total", seconds)
+
+    span = job_spans.pop(job["job_id"], None)
+    if span is not None:
+        span.set_attribute("job.status", job["status"])
+        if job["status"] == "error":
+            span.set_status_error(job.get("error") or "error")
+        span.end()
+
+# Tracing: OpenTelemetry-compatible spans, exported as OTLP/JSON either to a
+# JSON-lines file (readable by the collector's otlpjsonfile receiver) or to an
+# OTLP/HTTP endpoint. Incoming W3C traceparent headers are continued.
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none")  # "none", "file" or "otlp"
+TRACE_FILE = Path(os.environ.get("TRACE_FILE", str(BASE_DIR / "traces.jsonl")))
+OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318").rstrip("/")
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "2"))
+TRACE_BUFFER_SIZE = 10000  # Oldest unexported spans are dropped beyond this
+TRACING_ENABLED = TRACE_EXPORTER in ("file", "otlp")
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+finished_spans: collections.deque = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+job_spans: Dict[str, "Span"] = {}  # job id -> root span of the job, open until it finishes
+stage_spans: Dict[tuple, "Span"] = {}  # (job id, stage) -> open stage span
+
+class Span:
+    """A unit of work in a trace. Child spans inherit the trace id of `parent`."""
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, kind: int = SPAN_KIND_INTERNAL,
+                 attributes: Optional[dict] = None, trace_id: Optional[str] = None,
+                 parent_span_id: Optional[str] = None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent is not None else (trace_id or os.urandom(16).hex())
+        self.parent_span_id = parent.span_id if parent is not None else parent_span_id
+        self.span_id = os.urandom(8).hex()
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_status_error(self, message: str):
+        self.status = {"code": 2, "message": message[:500]}
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if TRACING_ENABLED:
+            finished_spans.append(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items()]
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.status:
+            span["status"] = self.status
+        return span
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+@contextmanager
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL, attributes: Optional[dict] = None):
+    """Run a block as a child span of the current span; exceptions mark it as failed."""
+    span = Span(name, parent=current_span.get(), kind=kind, attributes=attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.set_status_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current_span.reset(token)
+        span.end()
+
+def otlp_payload(spans: List[Span]) -> dict:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": "n-m3u8dl-processor"}},
+            {"key": "service.instance.id", "value": {"stringValue": INSTANCE_ID}}
+        ]},
+        "scopeSpans": [{"scope": {"name": "app"}, "spans": [span.to_otlp() for span in spans]}]
+    }]}
+
+async def flush_spans(session: Optional[aiohttp.ClientSession] = None):
+    """Export the buffered spans in one OTLP batch."""
+    spans = []
+    while finished_spans:
+        spans.append(finished_spans.popleft())
+    if not spans:
+        return
+    payload = otlp_payload(spans)
+    try:
+        if TRACE_EXPORTER == "file":
+            line = json.dumps(payload) + "\n"
+            def append():
+                with open(TRACE_FILE, "a") as trace_file:
+                    trace_file.write(line)
+            await anyio.to_thread.run_sync(append)
+        elif session is not None:
+            async with session.post(f"{OTLP_ENDPOINT}/v1/traces", json=payload) as response:
+                if response.status >= 300:
+                    raise RuntimeError(f"collector answered {response.status}")
+    except (OSError, RuntimeError, aiohttp.ClientError) as e:
+        logger.warning("Failed to export spans", extra={"fields": {"spans": len(spans), "error": str(e)}})
+
+async def export_spans():
+    """Background exporter: ships finished spans every TRACE_FLUSH_INTERVAL seconds."""
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) if TRACE_EXPORTER == "otlp" else None
+    try:
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+            await flush_spans(session)
+    finally:
+        await flush_spans(session)
+        if session is not None:
+            await session.close()
+
+class TracingMiddleware:
+    """Wrap every HTTP request in a server span, continuing an incoming traceparent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        match = TRACEPARENT_PATTERN.match(headers.get(b"traceparent", b"").decode("latin-1").strip())
+        span = Span(
+            f"{scope['method']} {scope['path']}",
+            kind=SPAN_KIND_SERVER,
+            trace_id=match.group(1) if match else None,
+            parent_span_id=match.group(2) if match else None,
+            attributes={"http.request.method": scope["method"], "url.path": scope["path"]}
+        )
+        if b"range" in headers:
+            span.set_attribute("http.request.header.range", headers[b"range"].decode("latin-1"))
+        sent = 0
+
+        async def traced_send(message):
+            nonlocal sent
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.response.status_code", message["status"])
+                if message["status"] >= 500:
+                    span.set_status_error(f"HTTP {message['status']}")
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        token = current_span.set(span)
+        try:
+            await self.app(scope, receive, traced_send)
+        except Exception as e:
+            span.set_status_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            current_span.reset(token)
+            route = scope.get("route")
+            if route is not None and getattr(route, "path", None):
+                # Low-cardinality name once routing has resolved the template
+                span.name = f"{scope['method']} {route.path}"
+            span.set_attribute("http.response.body.size", sent)
+            span.end()
+
+app.add_middleware(TracingMiddleware)
+
+@app.on_event("startup")
+async def start_monitors():
+    start_background(monitor_event_loop_lag())
+    if TRACING_ENABLED:
+        start_background(export_spans())
+
+@app.on_event("shutdown")
+async def stop_running_children():
+    """Don't leave downloads and muxes running once the server is gone."""
+    for handle in list(child_handles):
+        stop_child(handle)
 
 # Request models
 class ProcessRequest(BaseModel):
@@ -57,6 +751,19 @@ class ProcessRequest(BaseModel):
     log_level: str = Field(default="Debug", description="Log level")
     binary_merge: bool = Field(default=False, description="Enable binary merge mode")
     additional_args: Optional[List[str]] = Field(default=None, description="Additional N_m3u8DL-RE arguments")
+    priority: int = Field(default=1, ge=1, le=100, description="Relative weight for bandwidth sharing (weighted policy)")
+    force: bool = Field(default=False, description="Always start a new job, even if an identical one is running or finished")
+    live: bool = Field(default=False, description="Write a fragmented MP4 that can be watched via /live/{job_id} while it is muxed")
+    previews: Optional[bool] = Field(default=None, description="Generate thumbnails and a seek-preview sprite after the mux (default: server setting)")
+    hls: bool = Field(default=False, description="Mux a fragmented MP4 that /hls/{filename}.m3u8 can serve (the default faststart MP4 can't be)")
+
+class BatchProcessRequest(BaseModel):
+    jobs: List[ProcessRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE, description="Jobs to submit together")
+
+class JobStatusQuery(BaseModel):
+    job_ids: List[str] = Field(..., max_length=MAX_STATUS_QUERY_IDS, description="Job ids to look up")
+    fields: Optional[List[str]] = Field(default=None, description="Only return these job fields (job_id and revision are always included)")
+    changed_since: Optional[int] = Field(default=None, description="Only return jobs changed after this store version")
 
 class JobStatus(BaseModel):
     job_id: str
@@ -77,11 +784,21 @@ async def root():
         "endpoints": {
             "process": "POST /process - Trigger file processing",
             "jobs": "GET /jobs - List all jobs",
+            "process_batch": "POST /process/batch - Submit many jobs at once",
+            "batch_status": "GET /batches/{batch_id} - Aggregate batch progress",
             "job_status": "GET /jobs/{job_id} - Get job status",
+            "bulk_job_status": "POST /jobs/status - Get status of many jobs (with changed_since)",
             "files": "GET /files - List processed files",
+            "file_info": "GET /files/{filename}/info - Media info (duration, streams, languages)",
+            "file_previews": "GET /files/{filename}/previews - Thumbnails and seek-preview sprites",
             "stream": "GET /stream/{filename} - Stream file (playback)",
             "download": "GET /download/{filename} - Download file",
+            "live": "GET /live/{job_id} - Watch a live job's output while it is muxed",
+            "hls": "GET /hls/{filename}.m3u8 - Byte-range HLS playlist (jobs submitted with hls or live)",
+            "bundle": "POST /bundle - Stream several files as one ZIP/TAR (resumable)",
             "health": "GET /health - Health check",
+            "metrics": "GET /metrics - Prometheus metrics",
+            "stats": "GET /stats - Per-stage latency percentiles",
             "check_gdrive": "GET /check_gdrive - Verify Google Drive credentials",
             "debug": "GET /debug - Show detailed system info"
         }
@@ -93,21 +810,21 @@ async def health_check():
     tools_status = {}
 
     try:
-        result = subprocess.run(["/usr/local/bin/N_m3u8DL-RE", "--version"], 
+        result = subprocess.run([N_M3U8DL_RE_PATH, "--version"], 
                               capture_output=True, text=True, timeout=5)
         tools_status["N_m3u8DL-RE"] = "available" if result.returncode == 0 else "error"
     except:
         tools_status["N_m3u8DL-RE"] = "unavailable"
 
     try:
-        result = subprocess.run(["/usr/bin/ffmpeg", "-version"], 
+        result = subprocess.run([FFMPEG_PATH, "-version"], 
                               capture_output=True, text=True, timeout=5)
         tools_status["ffmpeg"] = "available" if result.returncode == 0 else "error"
     except:
         tools_status["ffmpeg"] = "unavailable"
 
     try:
-        subprocess.run(["/usr/local/bin/mp4decrypt"], 
+        subprocess.run([MP4DECRYPT_PATH], 
                       capture_output=True, text=True, timeout=5)
         tools_status["mp4decrypt"] = "available"
     except:
@@ -118,10 +835,41 @@ async def health_check():
         "timestamp": datetime.now().isoformat(),
         "tools": tools_status,
         "active_jobs": len(active_jobs),
+        "queued_jobs": len(queued_requests),
+        "running_jobs": len(running_tasks),
         "completed_jobs": len(completed_jobs),
         "files_available": len(list(STREAM_DIR.glob("*.mkv"))) + len(list(STREAM_DIR.glob("*.mp4")))
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics in the text exposition format."""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats")
+async def stage_stats():
+    """Per-stage latency percentiles (seconds) over the recent window, and the throughput model behind ETAs."""
+    stages = list(JOB_STAGES) + sorted(set(stage_windows) - set(JOB_STAGES))
+    return {
+        "window_seconds": STATS_WINDOW_SECONDS,
+        "stages": {
+            stage: stage_windows[stage].summary() if stage in stage_windows else {"count": 0}
+            for stage in stages
+        },
+        "throughput_model": [
+            {
+                "host": host,
+                "bitrate_class": klass,
+                **{field: round(value, 3) if isinstance(value, float) else value for field, value in entry.items()},
+                "predicted_seconds": round(model_seconds(entry), 3) if model_seconds(entry) is not None else None
+            }
+            for (host, klass), entry in sorted(throughput_model.items(), key=lambda item: tuple(part or "" for part in item[0]))
+        ]
+    }
+
 def upload_to_google_drive(file_path: Path) -> Optional[str]:
     """
     Upload file to Google Drive and return shareable link.
@@ -129,42 +877,6 @@ def upload_to_google_drive(file_path: Path) -> Optional[str]:
     Requires credentials.json to be pre-generated locally.
     """
     try:
-        # Debug: Print current working directory and check files
-        print(f"🔍 Current working directory: {os.getcwd()}")
-        print(f"🔍 Environment: HuggingFace Space")
-        print(f"🔍 Checking for credentials.json...")
-
-        # List all files in current directory first
-        try:
-            all_files = os.listdir('.')
-            print(f"🔍 ALL files in directory: {sorted(all_files)}")
-            print(f"   Total files: {len(all_files)}")
-
-            # Check for our specific files
-            json_files = [f for f in all_files if f.endswith('.json')]
-            yaml_files = [f for f in all_files if f.endswith('.yaml')]
-            py_files = [f for f in all_files if f.endswith('.py')]
-            print(f"   JSON files found: {json_files}")
-            print(f"   YAML files found: {yaml_files}")
-            print(f"   Python files found: {py_files}")
-
-            # Check file permissions and details
-            for filename in all_files:
-                try:
-                    file_path = Path(filename)
-                    if file_path.exists():
-                        size = file_path.stat().st_size
-                        print(f"   📄 {filename}: {size} bytes")
-                    else:
-                        print(f"   ❌ {filename}: not accessible")
-                except Exception as e:
-                    print(f"   ⚠️  {filename}: error checking - {e}")
-
-        except Exception as e:
-            print(f"   ❌ Error listing directory: {e}")
-            import traceback
-            traceback.print_exc()
-
         # Check multiple possible locations for credentials file
         possible_paths = [
             Path("credentials.json"),
@@ -174,35 +886,19 @@ def upload_to_google_drive(file_path: Path) -> Optional[str]:
 
         credentials_file = None
         for path in possible_paths:
-            exists = path.exists()
-            print(f"   Checking: {path} -> exists: {exists}")
-            if exists:
-                try:
-                    size = path.stat().st_size
-                    print(f"     ✅ File exists! Size: {size} bytes")
-                except Exception as e:
-                    print(f"     ⚠️  File exists but error getting size: {e}")
+            if path.exists():
                 credentials_file = path
                 break
-            else:
-                print(f"     ❌ File not found")
 
         if not credentials_file:
-            print("⚠️  credentials.json not found in any expected location.")
-            print("   Please ensure credentials.json is uploaded to the same directory as app.py")
-            print("   Expected locations:")
-            for path in possible_paths:
-                print(f"     - {path}")
+            logger.warning("credentials.json not found; upload it next to app.py", extra={"fields": {
+                "expected_locations": [str(path) for path in possible_paths]
+            }})
             return None
 
-        print(f"✅ Found credentials.json at: {credentials_file}")
-
         # Check file size to ensure it's not empty
-        file_size = credentials_file.stat().st_size
-        print(f"📄 credentials.json size: {file_size} bytes")
-
-        if file_size == 0:
-            print("❌ credentials.json is empty!")
+        if credentials_file.stat().st_size == 0:
+            logger.error("credentials.json is empty", extra={"fields": {"path": str(credentials_file)}})
             return None
 
         # Initialize GoogleAuth with settings - try multiple paths
@@ -215,41 +911,35 @@ def upload_to_google_drive(file_path: Path) -> Optional[str]:
                 break
 
         if not settings_file:
-            print("⚠️  settings.yaml not found!")
+            logger.warning("settings.yaml not found")
             return None
 
-        print(f"✅ Found settings.yaml at: {settings_file}")
         gauth = GoogleAuth(settings_file=str(settings_file))
 
         # Load saved credentials with absolute path
-        print(f"🔄 Loading credentials from: {credentials_file}")
         try:
             gauth.LoadCredentialsFile(str(credentials_file))
 
             if gauth.credentials is None:
-                print("❌ No valid credentials found in credentials.json")
-                print("   This usually means the credentials file is corrupted or expired")
-                print("   Please regenerate credentials.json locally and upload again")
-                print()
-                print("🔧 TROUBLESHOOTING:")
-                print("   1. Run 'python authenticate_gdrive.py' locally")
-                print("   2. Upload the generated credentials.json to HuggingFace")
-                print("   3. Make sure credentials.json is in the same directory as app.py")
-                print(f"   4. Current directory: {os.getcwd()}")
-                print(f"   5. Expected location: {credentials_file.absolute()}")
+                logger.error(
+                    "No valid credentials in credentials.json; regenerate it with "
+                    "'python authenticate_gdrive.py' and upload it again",
+                    extra={"fields": {"path": str(credentials_file.absolute())}}
+                )
                 return None
 
-            print("✅ Credentials loaded successfully!")
-
         except Exception as e:
-            print(f"❌ Error loading credentials: {e}")
-            print("   This suggests the credentials.json file is corrupted")
-            print("   Please regenerate it locally using: python authenticate_gdrive.py")
+            logger.error("credentials.json is corrupted; regenerate it with 'python authenticate_gdrive.py'",
+                         extra={"fields": {"path": str(credentials_file), "error": str(e)}})
             return None
 
+        logger.debug("Loaded Google Drive credentials", extra={"fields": {
+            "credentials": str(credentials_file), "settings": str(settings_file)
+        }})
+
         if gauth.access_token_expired:
             # Refresh them if expired
-            print("🔄 Refreshing expired access token...")
+            logger.info("Refreshing expired Google Drive access token")
             gauth.Refresh()
             # Save refreshed credentials
             gauth.SaveCredentialsFile(str(credentials_file))
@@ -276,9 +966,452 @@ def upload_to_google_drive(file_path: Path) -> Optional[str]:
         shareable_link = file_drive['alternateLink']
         return shareable_link
         
-    except Exception as e:
-        print(f"Error uploading to Google Drive: {e}")
+    except Exception:
+        logger.error("Google Drive upload failed", exc_info=True, extra={"fields": {"file": file_path.name}})
+        return None
+
+def get_url_host(url: str) -> str:
+    """Return the lowercased origin host of a stream URL."""
+    try:
+        return (urlsplit(url).hostname or "unknown").lower()
+    except ValueError:
+        return "unknown"
+
+def choose_thread_count(host: str) -> dict:
+    """
+    Pick N_m3u8DL-RE's --thread-count for a new download.
+    The host's learned target is capped by an even share of the global thread
+    budget across running downloads, and by an even share of the per-host
+    limit across downloads already hitting the same origin.
+    """
+    downloading = [job for job in active_jobs.values() if job.get("status") == "processing"]
+    concurrent_jobs = len(downloading) + 1
+    same_host_jobs = sum(1 for job in downloading if job.get("host") == host) + 1
+
+    budget_share = DOWNLOAD_THREAD_BUDGET // concurrent_jobs
+    host_share = MAX_THREADS_PER_HOST // same_host_jobs
+
+    stats = host_stats.get(host)
+    host_target = stats["target_threads"] if stats else DEFAULT_DOWNLOAD_THREADS
+
+    thread_count = max(MIN_DOWNLOAD_THREADS, min(host_target, budget_share, host_share))
+    if thread_count == host_target:
+        reason = "host_target"
+    elif thread_count == budget_share:
+        reason = "global_budget"
+    elif thread_count == host_share:
+        reason = "host_limit"
+    else:
+        reason = "minimum"
+
+    return {
+        "host": host,
+        "thread_count": thread_count,
+        "reason": reason,
+        "host_target": host_target,
+        "concurrent_jobs": concurrent_jobs,
+        "same_host_jobs": same_host_jobs,
+        "learned": stats is not None
+    }
+
+def has_option(args: List[str], *names: str) -> bool:
+    """Whether `args` set one of `names`, as "--name value", "--name=value" or "--name:value"."""
+    return any(re.split("[=:]", arg, maxsplit=1)[0] in names for arg in args)
+
+async def record_download_result(job_id: str, tuning: dict, size_bytes: int, seconds: float):
+    """
+    Feed achieved throughput back into the host's thread target and log the sample.
+    Throughput that keeps improving lets the target climb; a clear drop
+    against the host's average is treated as the origin pushing back.
+    """
+    host = tuning["host"]
+    threads = tuning["thread_count"]
+    mb_per_s = (size_bytes / (1024 * 1024)) / seconds if seconds > 0 else 0.0
+
+    stats = host_stats.setdefault(host, {
+        "target_threads": DEFAULT_DOWNLOAD_THREADS,
+        "ewma_mb_per_s": None,
+        "samples": 0
+    })
+    previous_target = stats["target_threads"]
+    average = stats["ewma_mb_per_s"]
+
+    # Very short downloads say more about startup latency than about the origin
+    if seconds >= 1 and size_bytes >= 1024 * 1024:
+        if average is None or mb_per_s > average * 1.05:
+            if threads >= previous_target:
+                stats["target_threads"] = min(MAX_THREADS_PER_HOST, previous_target + 2)
+        elif mb_per_s < average * 0.8:
+            stats["target_threads"] = max(MIN_DOWNLOAD_THREADS, int(threads * 0.75))
+
+        stats["ewma_mb_per_s"] = mb_per_s if average is None else 0.7 * average + 0.3 * mb_per_s
+        stats["samples"] += 1
+
+    result = {
+        "bytes": size_bytes,
+        "seconds": round(seconds, 3),
+        "throughput_mb_per_s": round(mb_per_s, 3),
+        "next_host_target": stats["target_threads"]
+    }
+    if job_id in active_jobs:
+        active_jobs[job_id]["download_stats"] = result
+
+    line = json.dumps({
+        "job_id": job_id,
+        "timestamp": datetime.now().isoformat(),
+        **tuning,
+        **result,
+        "previous_host_target": previous_target
+    }) + "\n"
+    def append():
+        with open(TUNING_LOG_FILE, "a") as log_file:
+            log_file.write(line)
+    try:
+        await anyio.to_thread.run_sync(append)
+    except OSError as e:
+        logger.warning("Failed to write tuning log", extra={"fields": {"error": str(e)}})
+
+def bitrate_class(bit_rate: Optional[int]) -> Optional[str]:
+    if not bit_rate:
+        return None
+    return next(label for limit, label in BITRATE_CLASSES if bit_rate / 1_000_000 < limit)
+
+def record_throughput_sample(job: dict, info: dict, size_bytes: int):
+    """Fold a finished job's download, remux and publish rates into the throughput model."""
+    stages = job["timings"]["stages"]
+    download_seconds = stages.get("download", {}).get("seconds")
+    if not download_seconds or size_bytes <= 0:
+        return
+    size_mb = size_bytes / (1024 * 1024)
+    remux_seconds = stages.get("remux", {}).get("seconds")
+    sample = {
+        "size_mb": size_mb,
+        "download_mb_per_s": size_mb / download_seconds,
+        "remux_mb_per_s": size_mb / remux_seconds if remux_seconds else None,
+        "publish_seconds": stages.get("publish", {}).get("seconds")
+    }
+
+    klass = bitrate_class(info.get("bit_rate"))
+    for key in {(job["host"], klass), (job["host"], None), (None, klass), (None, None)}:
+        entry = throughput_model.setdefault(key, {"samples": 0})
+        for field, value in sample.items():
+            if value is None:
+                continue
+            average = entry.get(field)
+            entry[field] = value if average is None else (1 - ETA_MODEL_ALPHA) * average + ETA_MODEL_ALPHA * value
+        entry["samples"] += 1
+
+def model_seconds(entry: Optional[dict]) -> Optional[float]:
+    """Expected run time (download + remux + publish) of a job matching a model entry."""
+    if not entry or not entry.get("download_mb_per_s"):
         return None
+    seconds = entry["size_mb"] / entry["download_mb_per_s"]
+    if entry.get("remux_mb_per_s"):
+        seconds += entry["size_mb"] / entry["remux_mb_per_s"]
+    return seconds + (entry.get("publish_seconds") or 0.0)
+
+def predict_job_seconds(host: str) -> Optional[dict]:
+    """
+    Predict a new job's run time from the most specific model entry with data.
+    The bitrate is only known once the output is probed, so a new job is
+    assumed to be in the class its host has served most often.
+    """
+    classes = {klass: entry["samples"] for (entry_host, klass), entry in throughput_model.items()
+               if entry_host == host and klass is not None}
+    klass = max(classes, key=classes.get) if classes else None
+    candidates = [((host, None), "host"), ((None, None), "global")]
+    if klass is not None:
+        candidates[1:1] = [((None, klass), "bitrate")]
+        candidates.insert(0, ((host, klass), "host_bitrate"))
+    for key, basis in candidates:
+        seconds = model_seconds(throughput_model.get(key))
+        if seconds is not None:
+            return {
+                "seconds": round(seconds, 3),
+                "basis": basis,
+                "bitrate_class": klass,
+                "samples": throughput_model[key]["samples"]
+            }
+    return None
+
+def queue_etas() -> Dict[str, dict]:
+    """
+    Queue position and expected start/finish (seconds from now) of every
+    queued job, from replaying the dispatcher over predicted run times.
+    The replay keeps to the queue order, so it overestimates a little when
+    a saturated host leaves a slot to another host's later job.
+    """
+    now = time.monotonic()
+    if now - queue_eta_cache["computed"] < ETA_REFRESH_SECONDS:
+        return queue_eta_cache["etas"]
+
+    # Jobs without a prediction of their own count as an average job
+    fallback = model_seconds(throughput_model.get((None, None)))
+
+    def expected(job: dict) -> Optional[float]:
+        return (job.get("prediction") or {}).get("seconds") or fallback
+
+    global_slots = [0.0] * MAX_CONCURRENT_JOBS  # When each slot frees up
+    host_slots: Dict[str, list] = {}
+    for job_id in running_tasks:
+        job = active_jobs.get(job_id)
+        if job is None or expected(job) is None:
+            continue
+        started = job["timings"]["stages"].get("queue", {}).get("end") or now
+        remaining = max(0.0, expected(job) - (now - started))
+        heapq.heapreplace(global_slots, remaining)
+        heapq.heapreplace(host_slots.setdefault(job["host"], [0.0] * MAX_JOBS_PER_HOST), remaining)
+
+    entries = sorted(
+        entry + (host,) for host, host_queue in host_queues.items() for entry in host_queue if entry[2] in queued_requests
+    )
+    etas = {}
+    for position, (_, _, job_id, host) in enumerate(entries, 1):
+        etas[job_id] = {"queue_position": position}
+        seconds = expected(active_jobs[job_id]) if job_id in active_jobs else None
+        if seconds is None:
+            continue
+        slots = host_slots.setdefault(host, [0.0] * MAX_JOBS_PER_HOST)
+        start = max(global_slots[0], slots[0])
+        heapq.heapreplace(global_slots, start + seconds)
+        heapq.heapreplace(slots, start + seconds)
+        etas[job_id].update({"start_in_seconds": round(start, 1), "finish_in_seconds": round(start + seconds, 1)})
+
+    queue_eta_cache.update(computed=now, etas=etas)
+    return etas
+
+def job_eta(job: dict) -> Optional[dict]:
+    """ETA fields for a queued or running job."""
+    predicted = (job.get("prediction") or {}).get("seconds")
+    if job["job_id"] in queued_requests:
+        etas = queue_etas()
+        if job["job_id"] not in etas:
+            # Queued after the cached replay
+            queue_eta_cache["computed"] = 0.0
+            etas = queue_etas()
+        return {"predicted_seconds": predicted, **etas.get(job["job_id"], {})}
+    started = job["timings"]["stages"].get("queue", {}).get("end")
+    if predicted is None or started is None:
+        return None
+    elapsed = time.monotonic() - started
+    return {
+        "predicted_seconds": predicted,
+        "elapsed_seconds": round(elapsed, 1),
+        "remaining_seconds": round(max(0.0, predicted - elapsed), 1)
+    }
+
+def bandwidth_weight(job_id: str) -> int:
+    """A job's weight in the ingress split under the current policy."""
+    job = active_jobs.get(job_id)
+    if BANDWIDTH_POLICY != "weighted" or job is None:
+        return 1
+    return job["request"].get("priority", 1)
+
+def acquire_bandwidth(job_id: str, request: ProcessRequest) -> Optional[str]:
+    """
+    Give a starting download its --max-speed and return it.
+    The budget is split by weight between the downloads actually running, the
+    ones dispatched alongside this one, and as many queued jobs as there are free
+    slots, so a lone download gets nearly all of it. Every slot without a
+    download keeps a floor in reserve and the limits never add up to more than
+    the budget.
+
+    N_m3u8DL-RE reads the limit once at launch, so running downloads can't be
+    rebalanced: budget freed by a finishing download sits idle until the next
+    one starts, and a download that starts while others hold the budget keeps
+    whatever was left (at least the floor) until it finishes.
+    """
+    if INGRESS_BUDGET_MB_PER_S <= 0:
+        return None
+
+    weight = request.priority if BANDWIDTH_POLICY == "weighted" else 1
+    floor = min(MIN_JOB_BANDWIDTH_MB_PER_S, INGRESS_BUDGET_MB_PER_S / MAX_CONCURRENT_JOBS)
+    other_limits = sum(allocation["limit_mb_per_s"] for allocation in bandwidth_allocations.values())
+    slots_left = max(0, MAX_CONCURRENT_JOBS - len(bandwidth_allocations) - 1)
+    available = INGRESS_BUDGET_MB_PER_S - other_limits - slots_left * floor
+
+    starting = [other for other in running_tasks if other != job_id and other not in bandwidth_allocations
+                and active_jobs.get(other, {}).get("status") == "queued"]
+    waiting = sorted((bandwidth_weight(other) for other in queued_requests), reverse=True)
+    contenders = (weight + sum(allocation["weight"] for allocation in bandwidth_allocations.values())
+                  + sum(bandwidth_weight(other) for other in starting)
+                  + sum(waiting[:max(0, slots_left - len(starting))]))
+    share = INGRESS_BUDGET_MB_PER_S * weight / contenders
+    limit = max(floor, min(share, available))
+
+    bandwidth_allocations[job_id] = {"weight": weight, "policy": BANDWIDTH_POLICY, "limit_mb_per_s": limit}
+    active_jobs[job_id]["bandwidth"] = {**bandwidth_allocations[job_id], "limit_mb_per_s": round(limit, 3)}
+    return f"{int(limit * 1024)}K"
+
+def release_bandwidth(job_id: str):
+    """Return a finished download's limit to the budget."""
+    bandwidth_allocations.pop(job_id, None)
+
+# Child processes are reaped with wait4() so their rusage isn't lost
+CHILD_IO_SAMPLE_INTERVAL = float(os.environ.get("CHILD_IO_SAMPLE_INTERVAL", "1"))
+child_handles: List[dict] = []  # Children still running, stopped at shutdown
+PROC_IO_FIELDS = ("rchar", "wchar", "read_bytes", "write_bytes")
+
+def read_proc_io(pid: int) -> Optional[dict]:
+    """I/O counters from /proc/<pid>/io (Linux only; also readable while the child is a zombie)."""
+    try:
+        with open(f"/proc/{pid}/io") as file:
+            fields = dict(line.split(": ", 1) for line in file.read().splitlines() if ": " in line)
+    except OSError:
+        return None
+    return {name: int(fields[name]) for name in PROC_IO_FIELDS if name in fields}
+
+def read_peak_rss_kb(pid: int) -> Optional[int]:
+    """VmHWM of the child's current image. rusage's ru_maxrss can't be used: exec
+    after (v)fork keeps the parent's high-water mark, so every child would report
+    at least this server's peak RSS."""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _run_child_blocking(cmd: List[str], cwd: Optional[Path], handle: dict) -> tuple:
+    started = time.monotonic()
+    # Own process group, so stopping it also stops what the tool spawned
+    process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, process_group=0)
+    with handle["lock"]:
+        handle["pid"] = process.pid
+    if handle["stop"]:
+        stop_child(handle)
+    output = {}
+
+    def drain(name, pipe):
+        output[name] = pipe.read()
+        pipe.close()
+
+    readers = [
+        threading.Thread(target=drain, args=("stdout", process.stdout), daemon=True),
+        threading.Thread(target=drain, args=("stderr", process.stderr), daemon=True)
+    ]
+    for reader in readers:
+        reader.start()
+
+    # The pipes close when the child exits; sample its counters until then
+    io = None
+    peak_rss_kb = 0
+    pending = readers
+    while pending:
+        io = read_proc_io(process.pid) or io
+        peak_rss_kb = max(peak_rss_kb, read_peak_rss_kb(process.pid) or 0)
+        pending[0].join(CHILD_IO_SAMPLE_INTERVAL)
+        pending = [reader for reader in pending if reader.is_alive()]
+    io = read_proc_io(process.pid) or io
+
+    # Wait for the exit without reaping, then reap under the lock so
+    # stop_child() can never signal a pid that was already reused
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    with handle["lock"]:
+        _, status, rusage = os.wait4(process.pid, 0)
+        handle["pid"] = None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        "wall_seconds": round(time.monotonic() - started, 3),
+        "cpu_user_seconds": round(rusage.ru_utime, 3),
+        "cpu_system_seconds": round(rusage.ru_stime, 3),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),  # Sampled, so very short children read low
+        **(io or {})
+    }
+    return process.returncode, output.get("stdout", b""), output.get("stderr", b""), usage
+
+def stop_child(handle: dict):
+    """Terminate a child started by run_child (and its process group) unless it was already reaped."""
+    with handle["lock"]:
+        handle["stop"] = True
+        if handle["pid"] is not None:
+            try:
+                os.killpg(handle["pid"], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+async def run_child(cmd: List[str], stage: str, cwd: Optional[Path] = None) -> tuple:
+    """
+    Run a child process to completion on a dedicated thread.
+    Returns (returncode, stdout, stderr, usage) where usage holds CPU time
+    from wait4() (incl. the child's own children), sampled peak RSS and
+    /proc I/O counters. Cancelling the caller terminates the child.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    handle = {"lock": threading.Lock(), "pid": None, "stop": False}
+
+    def settle(result=None, error=None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def deliver(*args):
+        try:
+            loop.call_soon_threadsafe(settle, *args)
+        except RuntimeError:
+            pass  # The loop closed at shutdown; nobody is waiting for the result
+
+    def target():
+        try:
+            result = _run_child_blocking(cmd, cwd, handle)
+        except Exception as e:
+            deliver(None, e)
+            return
+        deliver(result)
+
+    # Arguments are left out of the span: they carry decryption keys
+    with start_span(f"exec {Path(cmd[0]).name}", attributes={
+        "process.executable.name": Path(cmd[0]).name, "pipeline.stage": stage
+    }) as span:
+        child_handles.append(handle)
+        threading.Thread(target=target, name=f"child-{stage}", daemon=True).start()
+        try:
+            returncode, stdout, stderr, usage = await future
+        except asyncio.CancelledError:
+            # The thread still reaps the child once it has exited
+            stop_child(handle)
+            span.set_status_error("cancelled")
+            raise
+        finally:
+            child_handles.remove(handle)
+        span.set_attribute("process.exit_code", returncode)
+        span.set_attribute("process.stdout.bytes", len(stdout))
+        span.set_attribute("process.stderr.bytes", len(stderr))
+        for field, value in usage.items():
+            span.set_attribute(f"process.{field}", value)
+        if returncode != 0:
+            span.set_status_error(f"exit code {returncode}")
+
+    metric_child_cpu.inc(usage["cpu_user_seconds"], (stage, "user"))
+    metric_child_cpu.inc(usage["cpu_system_seconds"], (stage, "system"))
+    metric_child_io.inc(usage.get("read_bytes", 0), (stage, "read"))
+    metric_child_io.inc(usage.get("write_bytes", 0), (stage, "write"))
+    metric_child_peak_rss.observe(usage["peak_rss_mb"] * 1024 * 1024, (stage,))
+    return returncode, stdout, stderr, usage
+
+def record_child_usage(job_id: str, stage: str, usage: dict):
+    """Store a child's resource usage on the job and keep a running total."""
+    job = active_jobs.get(job_id)
+    if job is None:
+        return
+    resources = job.get("resources") or {}
+    resources[stage] = usage
+    totals = {}
+    for name, entry in resources.items():
+        if name == "total":
+            continue
+        for field in ("wall_seconds", "cpu_user_seconds", "cpu_system_seconds") + PROC_IO_FIELDS:
+            if field in entry:
+                totals[field] = round(totals.get(field, 0) + entry[field], 3)
+        totals["peak_rss_mb"] = max(totals.get("peak_rss_mb", 0), entry["peak_rss_mb"])
+    resources["total"] = totals
+    job["resources"] = resources
 
 async def run_n_m3u8dl_process(job_id: str, request: ProcessRequest):
     """Run N_m3u8DL-RE process in background."""
@@ -287,11 +1420,13 @@ async def run_n_m3u8dl_process(job_id: str, request: ProcessRequest):
     if not request.keys and not request.key:
         active_jobs[job_id]["status"] = "error"
         active_jobs[job_id]["error"] = "No decryption key(s) provided"
+        metric_job_failures.inc(labels=("no_key",))
+        metric_jobs_finished.inc(labels=("error",))
         return
 
     # Build command
     cmd = [
-        "/usr/local/bin/N_m3u8DL-RE",
+        N_M3U8DL_RE_PATH,
         request.url,
         "--save-name", request.save_name,
         "--select-video", request.select_video,
@@ -319,67 +1454,125 @@ async def run_n_m3u8dl_process(job_id: str, request: ProcessRequest):
     if request.additional_args:
         cmd.extend(request.additional_args)
 
+    # Pick a thread count unless the caller pinned one explicitly
+    tuning = None
+    if not has_option(request.additional_args or [], "--thread-count"):
+        tuning = choose_thread_count(get_url_host(request.url))
+        cmd.extend(["--thread-count", str(tuning["thread_count"])])
+        active_jobs[job_id]["download_tuning"] = tuning
+
     # Update job status
     active_jobs[job_id]["status"] = "processing"
+
+    # Take a share of the ingress budget unless the caller set a speed limit
+    if not has_option(request.additional_args or [], "--max-speed", "-R"):
+        max_speed = acquire_bandwidth(job_id, request)
+        if max_speed:
+            cmd.extend(["--max-speed", max_speed])
+
     active_jobs[job_id]["command"] = " ".join(cmd)
 
     try:
-        # Change to output directory
-        os.chdir(STREAM_DIR)
-
-        # Run the process
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-
-        stdout, stderr = await process.communicate()
+        # Run the process in the output directory
+        begin_stage(active_jobs[job_id], "download")
+        try:
+            returncode, stdout, stderr, usage = await run_child(cmd, "download", cwd=STREAM_DIR)
+        finally:
+            release_bandwidth(job_id)
+        if job_id not in active_jobs:
+            return  # Cancelled while the child ran
+        record_child_usage(job_id, "download", usage)
+        download_seconds = end_stage(active_jobs[job_id], "download", record=returncode == 0)
+        logger.info("Download finished", extra={"fields": {"returncode": returncode, "seconds": round(download_seconds, 3)}})
 
         # Check if successful
-        if process.returncode == 0:
+        if returncode == 0:
             output_file = STREAM_DIR / f"{request.save_name}.{request.format}"
 
             if output_file.exists():
+                metric_downloaded_bytes.inc(output_file.stat().st_size)
+                if job_id in job_spans:
+                    job_spans[job_id].set_attribute("download.bytes", output_file.stat().st_size)
+                if tuning:
+                    await record_download_result(job_id, tuning, output_file.stat().st_size, download_seconds)
+
                 # Convert MKV to MP4 using ffmpeg
                 try:
                     mkv_file = output_file
                     mp4_file = STREAM_DIR / f"{request.save_name}.mp4"
 
+                    # Live jobs get a fragmented MP4 that is playable while it grows;
+                    # faststart would only write the moov atom at the very end
+                    if request.live:
+                        movflags = "+frag_keyframe+empty_moov+default_base_moof"
+                    elif request.hls:
+                        # Keyframe fragments plus a global sidx index them for /hls
+                        movflags = "+frag_keyframe+empty_moov+default_base_moof+global_sidx"
+                    else:
+                        # No +faststart: write_faststart moves the moov box up itself
+                        # and checksums the MP4 while it writes it
+                        movflags = None
+
+                    # Default outputs are muxed to a scratch file first; /files only lists *.mp4
+                    mux_file = mp4_file if request.live or request.hls else STREAM_DIR / f"{request.save_name}.remux.tmp"
+
                     ffmpeg_cmd = [
-                        "/usr/bin/ffmpeg",
+                        FFMPEG_PATH,
                         "-fflags", "+genpts",
                         "-i", str(mkv_file),
                         "-map", "0:v",  # Map all video streams
                         "-map", "0:a",  # Map all audio streams
                         "-c", "copy",   # Copy streams (no re-encoding)
-                        "-movflags", "+faststart",
+                        *(["-movflags", movflags] if movflags else []),
                         "-max_interleave_delta", "0",
                         "-avoid_negative_ts", "make_zero",
+                        "-f", "mp4",
                         "-y",  # Overwrite output file without asking
-                        str(mp4_file)
+                        str(mux_file)
                     ]
 
+                    if request.live:
+                        # Never let /live serve a stale file left over from an earlier run
+                        if mp4_file != mkv_file:
+                            mp4_file.unlink(missing_ok=True)
+                        active_jobs[job_id]["live_file"] = mp4_file.name
+                        active_jobs[job_id]["live_url"] = f"/live/{job_id}"
+
                     active_jobs[job_id]["status"] = "converting"
 
                     # Run ffmpeg conversion
-                    ffmpeg_process = await asyncio.create_subprocess_exec(
-                        *ffmpeg_cmd,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-
-                    ffmpeg_stdout, ffmpeg_stderr = await ffmpeg_process.communicate()
-
-                    if ffmpeg_process.returncode == 0 and mp4_file.exists():
+                    begin_stage(active_jobs[job_id], "remux")
+                    output_checksum = None
+                    try:
+                        ffmpeg_returncode, ffmpeg_stdout, ffmpeg_stderr, ffmpeg_usage = await run_child(ffmpeg_cmd, "remux")
+                        if job_id not in active_jobs:
+                            return  # Cancelled while the child ran
+                        record_child_usage(job_id, "remux", ffmpeg_usage)
+                        if ffmpeg_returncode == 0 and mux_file != mp4_file and mux_file.exists():
+                            try:
+                                output_checksum = await anyio.to_thread.run_sync(write_faststart, mux_file, mp4_file)
+                            except (OSError, ValueError) as e:
+                                logger.warning("Faststart rewrite failed; publishing the MP4 as muxed",
+                                               extra={"fields": {"error": str(e)}})
+                                os.replace(mux_file, mp4_file)
+                    finally:
+                        if mux_file != mp4_file:
+                            mux_file.unlink(missing_ok=True)
+                    end_stage(active_jobs[job_id], "remux", record=ffmpeg_returncode == 0)
+
+                    if ffmpeg_returncode == 0 and mp4_file.exists():
+                        metric_remuxed_bytes.inc(mp4_file.stat().st_size)
+                        if job_id in job_spans:
+                            job_spans[job_id].set_attribute("remux.bytes", mp4_file.stat().st_size)
                         # Conversion successful, delete original MKV
                         try:
-                            mkv_file.unlink()
+                            if mkv_file != mp4_file:
+                                mkv_file.unlink()
                             final_file = mp4_file
                             final_filename = mp4_file.name
                         except Exception as e:
                             # If deletion fails, keep MKV and use it as final file
-                            print(f"Warning: Failed to delete MKV file: {e}")
+                            logger.warning("Failed to delete MKV file", extra={"fields": {"error": str(e)}})
                             final_file = mkv_file
                             final_filename = mkv_file.name
                     else:
@@ -387,6 +1580,9 @@ async def run_n_m3u8dl_process(job_id: str, request: ProcessRequest):
                         final_file = mkv_file
                         final_filename = mkv_file.name
                         active_jobs[job_id]["conversion_error"] = ffmpeg_stderr.decode() if ffmpeg_stderr else "FFmpeg conversion failed"
+                        metric_job_failures.inc(labels=("convert",))
+
+                    await record_output_checksum(job_id, final_file, output_checksum if final_file == mp4_file else None)
 
                     # Update job with final file info
                     active_jobs[job_id]["status"] = "completed"
@@ -395,54 +1591,659 @@ async def run_n_m3u8dl_process(job_id: str, request: ProcessRequest):
                     active_jobs[job_id]["completed_at"] = datetime.now().isoformat()
                     active_jobs[job_id]["file_size_mb"] = round(final_file.stat().st_size / (1024 * 1024), 2)
                     active_jobs[job_id]["converted_to_mp4"] = final_filename.endswith('.mp4')
+                    if final_filename.endswith('.mp4') and (request.live or request.hls):
+                        active_jobs[job_id]["hls_url"] = f"/hls/{quote(final_filename)}.m3u8"
 
                     # Upload to Google Drive if MP4
-                    if final_filename.endswith('.mp4'):
+                    begin_stage(active_jobs[job_id], "publish")
+                    if GDRIVE_UPLOAD and final_filename.endswith('.mp4'):
                         active_jobs[job_id]["status"] = "uploading_to_gdrive"
-                        
-                        gdrive_link = upload_to_google_drive(final_file)
+
+                        # PyDrive2 is blocking; keep it off the event loop
+                        with start_span("gdrive.upload", kind=SPAN_KIND_CLIENT, attributes={
+                            "file.size": final_file.stat().st_size
+                        }) as upload_span:
+                            gdrive_link = await anyio.to_thread.run_sync(upload_to_google_drive, final_file)
+                            if not gdrive_link:
+                                upload_span.set_status_error("upload failed")
                         if gdrive_link:
                             active_jobs[job_id]["gdrive_link"] = gdrive_link
                             active_jobs[job_id]["status"] = "completed"
-                            print(f"✅ Job {job_id}: Google Drive upload completed!")
+                            logger.info("Google Drive upload completed")
                         else:
                             active_jobs[job_id]["gdrive_error"] = "Failed to upload to Google Drive"
+                            metric_job_failures.inc(labels=("gdrive_upload",))
                             active_jobs[job_id]["status"] = "completed"
-                            print(f"❌ Job {job_id}: Google Drive upload failed")
+                            logger.warning("Google Drive upload failed")
 
                     # Move to completed jobs
                     completed_jobs[job_id] = active_jobs[job_id]
                     del active_jobs[job_id]
+                    metric_jobs_finished.inc(labels=("completed",))
+                    bump_file_index_version()
+                    end_stage(completed_jobs[job_id], "publish")
+                    start_background(post_process_output(job_id, STREAM_DIR / completed_jobs[job_id]["filename"]))
 
                 except Exception as e:
                     # If conversion fails, fall back to original MKV
+                    await record_output_checksum(job_id, output_file)
                     active_jobs[job_id]["status"] = "completed"
                     active_jobs[job_id]["filename"] = output_file.name
                     active_jobs[job_id]["url"] = f"/stream/{output_file.name}"
                     active_jobs[job_id]["completed_at"] = datetime.now().isoformat()
                     active_jobs[job_id]["file_size_mb"] = round(output_file.stat().st_size / (1024 * 1024), 2)
                     active_jobs[job_id]["conversion_error"] = str(e)
+                    metric_job_failures.inc(labels=("convert",))
 
                     # Move to completed jobs
                     completed_jobs[job_id] = active_jobs[job_id]
                     del active_jobs[job_id]
+                    metric_jobs_finished.inc(labels=("completed",))
+                    bump_file_index_version()
+                    start_background(post_process_output(job_id, STREAM_DIR / completed_jobs[job_id]["filename"]))
             else:
                 active_jobs[job_id]["status"] = "error"
                 active_jobs[job_id]["error"] = "Output file not found"
                 active_jobs[job_id]["stderr"] = stderr.decode() if stderr else ""
+                metric_job_failures.inc(labels=("output_missing",))
+                metric_jobs_finished.inc(labels=("error",))
         else:
             active_jobs[job_id]["status"] = "error"
-            active_jobs[job_id]["error"] = f"Process exited with code {process.returncode}"
+            active_jobs[job_id]["error"] = f"Process exited with code {returncode}"
             active_jobs[job_id]["stderr"] = stderr.decode() if stderr else ""
             active_jobs[job_id]["stdout"] = stdout.decode() if stdout else ""
+            metric_job_failures.inc(labels=("download_exit",))
+            metric_jobs_finished.inc(labels=("error",))
 
     except Exception as e:
+        release_bandwidth(job_id)
         active_jobs[job_id]["status"] = "error"
         active_jobs[job_id]["error"] = str(e)
         active_jobs[job_id]["completed_at"] = datetime.now().isoformat()
+        metric_job_failures.inc(labels=("exception",))
+        metric_jobs_finished.inc(labels=("error",))
+
+def compute_file_checksum(path: Path) -> dict:
+    """
+    Hash a finished output by reading it back (SHA-256 and CRC-32) and cache the result.
+    This is a full extra read of the file; only used when CHECKSUM_REREAD is on.
+    """
+    sha256 = hashlib.sha256()
+    crc = 0
+    with open(path, "rb", buffering=0) as f:
+        stat = os.fstat(f.fileno())
+        while chunk := f.read(SERVE_CHUNK_SIZE):
+            sha256.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+    return store_file_checksum(path, stat, sha256.hexdigest(), crc)
+
+def store_file_checksum(path: Path, stat: os.stat_result, sha256: str, crc: int) -> dict:
+    """Cache a checksum for `path` and save it next to the other output metadata."""
+    checksum = {
+        "ino": stat.st_ino,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256,
+        "crc32": crc
+    }
+    file_checksums[path.name] = checksum
+    crc32_cache[(stat.st_ino, stat.st_size, stat.st_mtime_ns)] = crc
+
+    try:
+        META_DIR.mkdir(parents=True, exist_ok=True)
+        (META_DIR / f"{path.name}.checksum.json").write_text(json.dumps(checksum))
+    except OSError as e:
+        logger.warning("Failed to save checksum", extra={"fields": {"file": path.name, "error": str(e)}})
+    return checksum
+
+# Boxes on the path from moov down to the chunk offset tables
+MP4_OFFSET_CONTAINERS = {"trak", "mdia", "minf", "stbl"}
+
+def shift_chunk_offsets(payload: bytes, shift: int, use_co64: bool) -> bytes:
+    """Rebuild a moov payload with every stco/co64 chunk offset moved by `shift`."""
+    out = bytearray()
+    for box_type, body in child_boxes(payload):
+        if box_type in MP4_OFFSET_CONTAINERS:
+            body = shift_chunk_offsets(body, shift, use_co64)
+        elif box_type in ("stco", "co64"):
+            width = "I" if box_type == "stco" else "Q"
+            count = struct.unpack(">I", body[4:8])[0]
+            offsets = [offset + shift for offset in struct.unpack(f">{count}{width}", body[8:8 + count * struct.calcsize(width)])]
+            if use_co64:
+                box_type, width = "co64", "Q"
+            # struct.error if an stco offset no longer fits in 32 bits
+            body = body[:8] + struct.pack(f">{count}{width}", *offsets)
+        out += struct.pack(">I4s", 8 + len(body), box_type.encode("latin-1")) + body
+    return bytes(out)
+
+def faststart_moov(payload: bytes) -> bytes:
+    """Return the moov box to put in front of the media data, offsets moved past it."""
+    for use_co64 in (False, True):
+        size = 8 + len(shift_chunk_offsets(payload, 0, use_co64))
+        try:
+            return struct.pack(">I4s", size, b"moov") + shift_chunk_offsets(payload, size, use_co64)
+        except struct.error:
+            continue  # Outputs past 4 GiB need 64-bit chunk offsets
+    raise ValueError("chunk offsets do not fit in co64")
+
+def read_file_range(file, offset: int, length: int):
+    """Yield `length` bytes of `file` from `offset` in SERVE_CHUNK_SIZE chunks."""
+    while length > 0:
+        chunk = os.pread(file.fileno(), min(length, SERVE_CHUNK_SIZE), offset)
+        if not chunk:
+            raise ValueError("file truncated while copying")
+        yield chunk
+        offset += len(chunk)
+        length -= len(chunk)
+
+def write_faststart(source: Path, path: Path) -> dict:
+    """
+    Write the remuxed MP4 `source` to `path` with its moov box in front of the
+    media data, hashing the bytes as they go out. This is the rewrite ffmpeg's
+    +faststart pass does, so the checksum needs no extra read of the output.
+    """
+    with open(source, "rb") as src:
+        end = os.fstat(src.fileno()).st_size
+        boxes = list(iter_boxes(src, 0, end))
+        if not boxes or boxes[-1][1] + boxes[-1][3] != end:
+            raise ValueError(f"{source.name} is not a well-formed MP4")
+        moov = next((box for box in boxes if box[0] == "moov"), None)
+        first_mdat = next((index for index, box in enumerate(boxes) if box[0] == "mdat"), None)
+        if moov is None or first_mdat is None:
+            raise ValueError(f"{source.name} has no moov or mdat box")
+
+        layout = [(offset, size) for box_type, offset, _, size in boxes if box_type != "moov"]
+        if boxes.index(moov) < first_mdat:
+            layout.insert(boxes.index(moov), (moov[1], moov[3]))  # Already at the front
+        else:
+            # Right after ftyp, where ffmpeg's +faststart puts it
+            layout.insert(1 if boxes[0][0] == "ftyp" else 0, faststart_moov(read_box_payload(src, *moov[1:])))
+
+        sha256 = hashlib.sha256()
+        crc = 0
+        with open(path, "wb") as dst:
+            for part in layout:
+                for chunk in [part] if isinstance(part, bytes) else read_file_range(src, *part):
+                    dst.write(chunk)
+                    sha256.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+    return store_file_checksum(path, path.stat(), sha256.hexdigest(), crc)
+
+def get_file_checksum(path: Path, stat: os.stat_result) -> Optional[dict]:
+    """Return the stored checksum of `path` if it still matches the file on disk."""
+    checksum = file_checksums.get(path.name)
+    if checksum is None:
+        try:
+            checksum = json.loads((META_DIR / f"{path.name}.checksum.json").read_text())
+        except (OSError, ValueError):
+            return None
+        file_checksums[path.name] = checksum
+
+    if (checksum.get("ino"), checksum.get("size"), checksum.get("mtime_ns")) != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+        return None
+    crc32_cache[(stat.st_ino, stat.st_size, stat.st_mtime_ns)] = checksum["crc32"]
+    return checksum
+
+def digest_header(checksum: dict) -> str:
+    """RFC 3230 Digest header value for a stored checksum."""
+    return "sha-256=" + base64.b64encode(bytes.fromhex(checksum["sha256"])).decode()
+
+async def record_output_checksum(job_id: str, path: Path, checksum: Optional[dict] = None):
+    """
+    Store a job's output checksum on the job. Outputs the app didn't write itself
+    are only read back to hash them when CHECKSUM_REREAD is on.
+    """
+    if checksum is not None:
+        active_jobs[job_id]["sha256"] = checksum["sha256"]
+        return
+    if not CHECKSUM_REREAD:
+        return
+    begin_stage(active_jobs[job_id], "post_process")
+    try:
+        checksum = await anyio.to_thread.run_sync(compute_file_checksum, path)
+        active_jobs[job_id]["sha256"] = checksum["sha256"]
+    except OSError as e:
+        active_jobs[job_id]["checksum_error"] = str(e)
+        metric_job_failures.inc(labels=("checksum",))
+    end_stage(active_jobs[job_id], "post_process")
+
+def start_background(coroutine):
+    """Run a post-job coroutine without blocking the job that started it."""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def summarize_probe(data: dict) -> dict:
+    """Reduce ffprobe's JSON to the fields clients ask for."""
+    media_format = data.get("format", {})
+    streams = []
+    for stream in data.get("streams", []):
+        tags = stream.get("tags", {})
+        entry = {
+            "index": stream.get("index"),
+            "type": stream.get("codec_type"),
+            "codec": stream.get("codec_name"),
+            "profile": stream.get("profile"),
+            "bit_rate": int(stream["bit_rate"]) if stream.get("bit_rate", "").isdigit() else None,
+            "language": tags.get("language"),
+            "title": tags.get("title")
+        }
+        if stream.get("codec_type") == "video":
+            entry.update({
+                "width": stream.get("width"),
+                "height": stream.get("height"),
+                "frame_rate": stream.get("avg_frame_rate") or stream.get("r_frame_rate")
+            })
+        elif stream.get("codec_type") == "audio":
+            entry.update({
+                "channels": stream.get("channels"),
+                "sample_rate": int(stream["sample_rate"]) if stream.get("sample_rate", "").isdigit() else None
+            })
+        streams.append(entry)
+
+    def as_number(value, cast):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        "format": media_format.get("format_name"),
+        "duration": as_number(media_format.get("duration"), float),
+        "bit_rate": as_number(media_format.get("bit_rate"), int),
+        "streams": streams,
+        "video_tracks": sum(1 for stream in streams if stream["type"] == "video"),
+        "audio_languages": [stream["language"] for stream in streams if stream["type"] == "audio" and stream["language"]],
+        "subtitle_languages": [stream["language"] for stream in streams if stream["type"] == "subtitle" and stream["language"]]
+    }
+
+def cached_probe(path: Path, stat: os.stat_result) -> Optional[dict]:
+    """Return the probe result for `path` from memory or its sidecar if the file is unchanged."""
+    entry = probe_cache.get(path.name)
+    if entry is None:
+        try:
+            entry = json.loads((META_DIR / f"{path.name}.probe.json").read_text())
+        except (OSError, ValueError):
+            return None
+        probe_cache[path.name] = entry
+    if (entry.get("ino"), entry.get("mtime_ns")) != (stat.st_ino, stat.st_mtime_ns):
+        return None
+    return entry["info"]
+
+async def _run_probe(path: Path, stat: os.stat_result) -> dict:
+    async with probe_semaphore:
+        started = time.monotonic()
+        returncode, stdout, stderr, _ = await run_child(
+            [FFPROBE_PATH, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", str(path)],
+            "probe"
+        )
+        observe_stage("probe", time.monotonic() - started)
+    if returncode != 0:
+        metric_job_failures.inc(labels=("probe",))
+        raise RuntimeError(stderr.decode(errors="replace").strip() or f"ffprobe exited with code {returncode}")
+
+    info = summarize_probe(json.loads(stdout))
+    entry = {"ino": stat.st_ino, "mtime_ns": stat.st_mtime_ns, "info": info}
+    probe_cache[path.name] = entry
+    try:
+        META_DIR.mkdir(parents=True, exist_ok=True)
+        (META_DIR / f"{path.name}.probe.json").write_text(json.dumps(entry))
+    except OSError as e:
+        logger.warning("Failed to save probe", extra={"fields": {"file": path.name, "error": str(e)}})
+    bump_file_index_version()
+    return info
+
+async def probe_output(path: Path) -> dict:
+    """
+    Media info for an output, probed at most once per inode+mtime.
+    Probes run in a pool of PROBE_CONCURRENCY and concurrent callers share one run.
+    """
+    stat = path.stat()
+    info = cached_probe(path, stat)
+    if info is not None:
+        return info
+
+    key = (path.name, stat.st_ino, stat.st_mtime_ns)
+    task = probe_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_run_probe(path, stat))
+        probe_inflight[key] = task
+        task.add_done_callback(lambda _: probe_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+def format_vtt_time(seconds: float) -> str:
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+def cached_previews(path: Path, stat: os.stat_result) -> Optional[dict]:
+    """Return the preview manifest for `path` if it was built for the current file."""
+    try:
+        manifest = json.loads((META_DIR / f"{path.name}.previews" / "manifest.json").read_text())
+    except (OSError, ValueError):
+        return None
+    if (manifest.get("ino"), manifest.get("mtime_ns")) != (stat.st_ino, stat.st_mtime_ns):
+        return None
+    if "generation" not in manifest:
+        return None  # Built before asset URLs were versioned
+    return manifest
+
+async def _build_previews(path: Path, stat: os.stat_result) -> dict:
+    info = await probe_output(path)
+    video = next((stream for stream in info["streams"] if stream["type"] == "video"), None)
+    if video is None or not video.get("width") or not video.get("height"):
+        raise ValueError("No video stream to preview")
+    thumb_height = round(PREVIEW_WIDTH * video["height"] / video["width"] / 2) * 2
+    duration = info.get("duration") or 0
+    columns, rows = PREVIEW_TILE
+
+    output_dir = META_DIR / f"{path.name}.previews"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    output_dir.mkdir(parents=True)
+    # Every build gets new asset URLs, since the file names are reused
+    generation = uuid.uuid4().hex[:12]
+
+    # Decode keyframes only, keep one every PREVIEW_INTERVAL seconds, and write
+    # them both as single thumbnails and tiled into sprite sheets
+    select = f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{PREVIEW_INTERVAL})'"
+    cmd = [
+        FFMPEG_PATH, "-hide_banner", "-nostats", "-threads", "1",
+        "-skip_frame", "nokey", "-i", str(path),
+        "-filter_complex",
+        f"[0:v]{select},showinfo,scale={PREVIEW_WIDTH}:{thumb_height},split=2[thumbs][sheet];"
+        f"[sheet]tile={columns}x{rows}[sprite]",
+        "-map", "[thumbs]", "-vsync", "vfr", "-q:v", "5", str(output_dir / "thumb_%04d.jpg"),
+        "-map", "[sprite]", "-vsync", "vfr", "-q:v", "5", str(output_dir / "sprite_%03d.jpg")
+    ]
+    async with preview_semaphore:
+        started = time.monotonic()
+        returncode, _, stderr, _ = await run_child(cmd, "previews")
+        observe_stage("previews", time.monotonic() - started)
+    if returncode != 0:
+        metric_job_failures.inc(labels=("previews",))
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise RuntimeError(f"ffmpeg exited with code {returncode}")
+
+    # showinfo logs the timestamp of every selected keyframe
+    times = [float(value) for value in re.findall(r"pts_time:\s*([\d.]+)", stderr.decode(errors="replace"))]
+    thumbnails = sorted(file.name for file in output_dir.glob("thumb_*.jpg"))
+    sprites = sorted(file.name for file in output_dir.glob("sprite_*.jpg"))
+    if len(times) < len(thumbnails):
+        times += [index * PREVIEW_INTERVAL for index in range(len(times), len(thumbnails))]
+
+    cues = ["WEBVTT", ""]
+    per_sheet = columns * rows
+    for index, name in enumerate(thumbnails):
+        start = times[index] if index else 0.0  # First cue covers the very start
+        end = times[index + 1] if index + 1 < len(thumbnails) else max(duration, start + PREVIEW_INTERVAL)
+        position = index % per_sheet
+        x, y = (position % columns) * PREVIEW_WIDTH, (position // columns) * thumb_height
+        cues.append(f"{format_vtt_time(start)} --> {format_vtt_time(end)}")
+        cues.append(f"sprite_{index // per_sheet + 1:03d}.jpg?v={generation}#xywh={x},{y},{PREVIEW_WIDTH},{thumb_height}")
+        cues.append("")
+    (output_dir / "sprite.vtt").write_text("\n".join(cues))
+
+    manifest = {
+        "ino": stat.st_ino,
+        "mtime_ns": stat.st_mtime_ns,
+        "generation": generation,
+        "interval": PREVIEW_INTERVAL,
+        "width": PREVIEW_WIDTH,
+        "height": thumb_height,
+        "tile": f"{columns}x{rows}",
+        "thumbnails": [{"time": round(times[index], 3), "file": name} for index, name in enumerate(thumbnails)],
+        "sprites": sprites,
+        "vtt": "sprite.vtt"
+    }
+    (output_dir / "manifest.json").write_text(json.dumps(manifest))
+    return manifest
+
+async def generate_previews(path: Path) -> dict:
+    """Thumbnails and sprite sheets for an MP4, built once per inode+mtime."""
+    stat = path.stat()
+    manifest = cached_previews(path, stat)
+    if manifest is not None:
+        return manifest
+
+    key = (path.name, stat.st_ino, stat.st_mtime_ns)
+    task = preview_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_build_previews(path, stat))
+        preview_inflight[key] = task
+        task.add_done_callback(lambda _: preview_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+async def post_process_output(job_id: str, path: Path):
+    """Post-job stages for a published output: media probe, then optional previews."""
+    job = completed_jobs.get(job_id)
+    try:
+        info = await probe_output(path)
+        if job is not None:
+            record_throughput_sample(job, info, path.stat().st_size)
+    except (OSError, RuntimeError, ValueError) as e:
+        logger.warning("Failed to probe output", extra={"fields": {"file": path.name, "error": str(e)}})
+
+    if job is None:
+        return
+    wanted = job["request"].get("previews")
+    if GENERATE_PREVIEWS if wanted is None else wanted:
+        await add_job_previews(job, path)
+
+async def add_job_previews(job: dict, path: Path):
+    """Generate previews for a job's MP4 output and track their status on the job."""
+    if path.suffix != ".mp4":
+        return
+    job["previews"] = {"status": "generating"}
+    try:
+        await generate_previews(path)
+        job["previews"] = {"status": "ready", "url": f"/files/{path.name}/previews"}
+    except (OSError, RuntimeError, ValueError) as e:
+        job["previews"] = {"status": "error", "error": str(e)}
+
+def validate_process_request(request: ProcessRequest):
+    """Reject requests that can never succeed before a job is created."""
+    if not request.keys and not request.key:
+        raise HTTPException(
+            status_code=400,
+            detail="At least one decryption key must be provided. Use 'key' for single key or 'keys' for multiple keys."
+        )
+
+def normalize_stream_url(url: str) -> str:
+    """Canonical form of a stream URL: lowercased origin, sorted query, no auth tokens."""
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if port and not (scheme == "http" and port == 80) and not (scheme == "https" and port == 443):
+        host = f"{host}:{port}"
+
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in FINGERPRINT_IGNORED_PARAMS and not name.lower().startswith("x-amz-")
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+def request_fingerprint(request: ProcessRequest) -> str:
+    """
+    Identify requests that would produce the same output file.
+    Decryption keys and scheduling options are left out; the output name
+    decides the path, and live and HLS jobs are muxed differently.
+    """
+    identity = {
+        "url": normalize_stream_url(request.url),
+        "save_name": request.save_name,
+        "live": request.live,
+        "hls": request.hls,
+        "select_video": request.select_video,
+        "select_audio": request.select_audio,
+        "select_subtitle": request.select_subtitle,
+        "format": request.format,
+        "binary_merge": request.binary_merge,
+        "additional_args": request.additional_args or []
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+def find_reusable_job(request: ProcessRequest) -> Optional[dict]:
+    """Return an in-flight job, or a completed job whose output is still on disk unchanged, for the same request."""
+    job_id = job_fingerprints.get(request_fingerprint(request))
+    if job_id is None:
+        return None
+
+    job = active_jobs.get(job_id)
+    if job is not None:
+        return job if job["status"] not in FINISHED_STATUSES else None
+
+    job = completed_jobs.get(job_id)
+    if job is None or job["status"] != "completed" or not job.get("filename") or not job.get("sha256"):
+        return None
+    # Another job (forced, or for another URL) may have rewritten the file since
+    try:
+        path = STREAM_DIR / job["filename"]
+        checksum = get_file_checksum(path, path.stat())
+    except OSError:
+        return None
+    if checksum is None or checksum["sha256"] != job["sha256"]:
+        return None
+    return job
+
+def attach_duplicate(job: dict, request: ProcessRequest) -> dict:
+    """Count a coalesced submission against an existing job and describe it to the caller."""
+    # Previews asked for by the new submission are added to the existing job
+    wanted = GENERATE_PREVIEWS if request.previews is None else request.previews
+    had = job["request"].get("previews")
+    if wanted and not (GENERATE_PREVIEWS if had is None else had):
+        job["request"] = {**job["request"], "previews": True}
+        if job["status"] == "completed" and job.get("previews") is None:
+            start_background(add_job_previews(job, STREAM_DIR / job["filename"]))
+    job["duplicate_submissions"] = job.get("duplicate_submissions", 0) + 1
+    metric_jobs_deduplicated.inc()
+    span = current_span.get()
+    if span is not None:
+        span.set_attribute("job.deduplicated_to", job["job_id"])
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "deduplicated": True,
+        "message": "Identical job already finished" if job["status"] == "completed" else "Attached to identical in-flight job",
+        "check_status": f"/jobs/{job['job_id']}",
+        "filename": job.get("filename"),
+        "url": job.get("url")
+    }
+
+def create_job(request: ProcessRequest, batch_id: Optional[str] = None) -> str:
+    """Create the job record for a validated request and return its id."""
+    job_id = str(uuid.uuid4())
+    fingerprint = request_fingerprint(request)
+    job_fingerprints[fingerprint] = job_id
+    host = get_url_host(request.url)
+    active_jobs[job_id] = JobRecord({
+        "job_id": job_id,
+        "status": "queued",
+        "request": request.model_dump(),
+        "fingerprint": fingerprint,
+        "host": host,
+        "batch_id": batch_id,
+        "started_at": datetime.now().isoformat(),
+        "filename": None,
+        "url": None,
+        "completed_at": None,
+        "error": None,
+        # Monotonic clock readings for each stage transition
+        "timings": {"clock": "monotonic", "submitted": round(time.monotonic(), 6), "stages": {}},
+        "prediction": predict_job_seconds(host),
+        "revision": bump_job_store_version()
+    })
+    job_spans[job_id] = Span("job", parent=current_span.get(), attributes={
+        "job.id": job_id, "job.host": active_jobs[job_id]["host"], "job.save_name": request.save_name
+    })
+    active_jobs[job_id]["trace_id"] = job_spans[job_id].trace_id
+    begin_stage(active_jobs[job_id], "queue")
+    metric_jobs_submitted.inc()
+    logger.info("Job queued", extra={"fields": {"job_id": job_id, "host": active_jobs[job_id]["host"], "batch_id": batch_id}})
+    return job_id
+
+def enqueue_job(job_id: str, request: ProcessRequest, dispatch: bool = True):
+    """Queue a job under its origin host and start it if capacity allows."""
+    job = active_jobs[job_id]
+    sequence = next(job_sequence)
+    sort_key = sequence
+    if SCHEDULER_POLICY == "sejf":
+        # Expected finish if started at submission: shorter jobs go first, but
+        # a job can only be overtaken by jobs submitted within its own
+        # predicted run time, so long jobs are never starved
+        predicted = (job.get("prediction") or {}).get("seconds")
+        if predicted is None:
+            predicted = model_seconds(throughput_model.get((None, None))) or 0.0
+        sort_key = job["timings"]["submitted"] + predicted
+    queued_requests[job_id] = request
+    heapq.heappush(host_queues.setdefault(job["host"], []), (sort_key, sequence, job_id))
+    if dispatch:
+        dispatch_jobs()
+
+def _next_dispatchable_host() -> Optional[str]:
+    """Return the host whose head job should start next, skipping saturated hosts."""
+    best_host = None
+    best_entry = None
+    for host, host_queue in host_queues.items():
+        # Drop jobs cancelled while they were waiting
+        while host_queue and host_queue[0][2] not in queued_requests:
+            heapq.heappop(host_queue)
+        if not host_queue or running_per_host.get(host, 0) >= MAX_JOBS_PER_HOST:
+            continue
+        if best_entry is None or host_queue[0] < best_entry:
+            best_host, best_entry = host, host_queue[0]
+    return best_host
+
+def dispatch_jobs():
+    """Start queued jobs while global and per-host capacity allows."""
+    while len(running_tasks) < MAX_CONCURRENT_JOBS:
+        host = _next_dispatchable_host()
+        if host is None:
+            break
+
+        _, _, job_id = heapq.heappop(host_queues[host])
+        if not host_queues[host]:
+            del host_queues[host]
+        request = queued_requests.pop(job_id)
+
+        running_per_host[host] = running_per_host.get(host, 0) + 1
+        running_tasks[job_id] = asyncio.create_task(run_scheduled_job(job_id, host, request))
+
+async def run_scheduled_job(job_id: str, host: str, request: ProcessRequest):
+    """Run a dispatched job and hand its slot to the next queued job."""
+    current_job_id.set(job_id)  # This task (and what it spawns) logs under the job
+    current_span.set(job_spans.get(job_id))
+    queue_seconds = end_stage(active_jobs[job_id], "queue")
+    logger.info("Job started", extra={"fields": {"host": host, "queue_seconds": round(queue_seconds, 3)}})
+    try:
+        await run_n_m3u8dl_process(job_id, request)
+    finally:
+        job = active_jobs.get(job_id) or completed_jobs.get(job_id)
+        if job is not None:
+            finish_job_timings(job)
+            logger.log(
+                logging.ERROR if job["status"] == "error" else logging.INFO,
+                "Job finished",
+                extra={"fields": {
+                    "status": job["status"],
+                    "error": job.get("error"),
+                    "filename": job.get("filename"),
+                    "total_seconds": job["timings"].get("total_seconds")
+                }}
+            )
+        running_tasks.pop(job_id, None)
+        running_per_host[host] -= 1
+        if running_per_host[host] <= 0:
+            del running_per_host[host]
+        dispatch_jobs()
 
 @app.post("/process")
-async def process_file(request: ProcessRequest, background_tasks: BackgroundTasks):
+async def process_file(request: ProcessRequest):
     """
     Trigger N_m3u8DL-RE processing via API.
 
@@ -476,45 +2277,162 @@ async def process_file(request: ProcessRequest, background_tasks: BackgroundTask
       }'
     ```
     """
-    # Validate that at least one key is provided
-    if not request.keys and not request.key:
-        raise HTTPException(
-            status_code=400,
-            detail="At least one decryption key must be provided. Use 'key' for single key or 'keys' for multiple keys."
-        )
-    
-    # Generate job ID
-    job_id = str(uuid.uuid4())
+    validate_process_request(request)
+
+    # Identical requests reuse the running or finished job unless forced
+    if not request.force:
+        existing_job = find_reusable_job(request)
+        if existing_job is not None:
+            return attach_duplicate(existing_job, request)
+
+    job_id = create_job(request)
 
-    # Create job entry
-    active_jobs[job_id] = {
+    # Hand the job to the scheduler
+    enqueue_job(job_id, request)
+
+    return {
         "job_id": job_id,
         "status": "queued",
-        "request": request.model_dump(),
-        "started_at": datetime.now().isoformat(),
-        "filename": None,
-        "url": None,
-        "completed_at": None,
-        "error": None
+        "message": "Job queued",
+        "check_status": f"/jobs/{job_id}",
+        "estimated_filename": f"{request.save_name}.{request.format}",
+        "predicted_seconds": (active_jobs[job_id]["prediction"] or {}).get("seconds")
     }
 
-    # Start processing in background
-    background_tasks.add_task(run_n_m3u8dl_process, job_id, request)
+@app.post("/process/batch")
+async def process_batch(batch: BatchProcessRequest):
+    """
+    Submit many jobs in one call.
+
+    Every request is validated before any job is created, so a bad entry
+    rejects the whole batch. Progress for the batch is available at
+    /batches/{batch_id}.
+    """
+    for index, request in enumerate(batch.jobs):
+        try:
+            validate_process_request(request)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"jobs[{index}]: {e.detail}")
+
+    batch_id = str(uuid.uuid4())
+
+    # Create and queue all jobs without yielding to the event loop, then dispatch once.
+    # Duplicates (including repeats within the batch) reuse the existing job id.
+    job_ids = []
+    deduplicated = 0
+    for request in batch.jobs:
+        existing_job = None if request.force else find_reusable_job(request)
+        if existing_job is not None:
+            attach_duplicate(existing_job, request)
+            job_ids.append(existing_job["job_id"])
+            deduplicated += 1
+            continue
+        job_id = create_job(request, batch_id=batch_id)
+        enqueue_job(job_id, request, dispatch=False)
+        job_ids.append(job_id)
+
+    # Repeats within the batch share a job; count it once for progress
+    unique_job_ids = list(dict.fromkeys(job_ids))
+    batches[batch_id] = {
+        "batch_id": batch_id,
+        "job_ids": unique_job_ids,
+        "created_at": datetime.now().isoformat()
+    }
+    dispatch_jobs()
 
     return {
-        "job_id": job_id,
+        "batch_id": batch_id,
         "status": "queued",
-        "message": "Processing started",
-        "check_status": f"/jobs/{job_id}",
-        "estimated_filename": f"{request.save_name}.{request.format}"
+        "job_count": len(unique_job_ids),
+        "deduplicated": deduplicated,
+        "job_ids": job_ids,
+        "check_status": f"/batches/{batch_id}"
     }
 
+@app.get("/batches/{batch_id}")
+async def get_batch_status(batch_id: str):
+    """Aggregate progress of a batch submitted via /process/batch."""
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+
+    batch = batches[batch_id]
+    status_counts: Dict[str, int] = {}
+    failed = []
+    for job_id in batch["job_ids"]:
+        job = active_jobs.get(job_id) or completed_jobs.get(job_id)
+        status = job["status"] if job else "unknown"
+        status_counts[status] = status_counts.get(status, 0) + 1
+        if status == "error":
+            failed.append({"job_id": job_id, "error": job.get("error")})
+
+    total = len(batch["job_ids"])
+    finished = sum(status_counts.get(status, 0) for status in FINISHED_STATUSES)
+    return {
+        "batch_id": batch_id,
+        "created_at": batch["created_at"],
+        "total": total,
+        "finished": finished,
+        "progress_percent": round(100 * finished / total, 1) if total else 100.0,
+        "done": finished == total,
+        "status_counts": status_counts,
+        "failed": failed
+    }
+
+def cached_json_response(request: Request, name: str, version: str, build) -> Response:
+    """
+    Serve a JSON payload with an ETag derived from `version`.
+    The payload is only rebuilt and re-serialized when the version changes,
+    and a matching If-None-Match is answered with 304 without touching it.
+    """
+    etag = f'"{INSTANCE_ID}-{name}-{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    entry = response_cache.get(name)
+    if entry is None or entry["etag"] != etag:
+        entry = {"etag": etag, "body": json.dumps(build()).encode()}
+        response_cache[name] = entry
+
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
 @app.get("/jobs")
-async def list_jobs():
+async def list_jobs(request: Request):
     """List all jobs (active and completed)."""
-    return {
+    return cached_json_response(request, "jobs", str(job_store_version), lambda: {
         "active": list(active_jobs.values()),
         "completed": list(completed_jobs.values())[-20:]  # Last 20 completed jobs
+    })
+
+@app.post("/jobs/status")
+async def bulk_job_status(query: JobStatusQuery):
+    """
+    Look up many jobs at once.
+
+    Pass the returned `version` as `changed_since` on the next call to get
+    only the jobs that changed in between.
+    """
+    jobs = {}
+    not_found = []
+    unchanged = 0
+    for job_id in query.job_ids:
+        job = active_jobs.get(job_id) or completed_jobs.get(job_id)
+        if job is None:
+            not_found.append(job_id)
+            continue
+        if query.changed_since is not None and job.get("revision", 0) <= query.changed_since:
+            unchanged += 1
+            continue
+        if query.fields:
+            job = {field: job[field] for field in ("job_id", "revision", *query.fields) if field in job}
+        jobs[job_id] = job
+
+    return {
+        "version": job_store_version,
+        "jobs": jobs,
+        "unchanged": unchanged,
+        "not_found": not_found
     }
 
 @app.get("/jobs/{job_id}")
@@ -523,7 +2441,7 @@ async def get_job_status(job_id: str):
 
     # Check active jobs
     if job_id in active_jobs:
-        return active_jobs[job_id]
+        return {**active_jobs[job_id], "eta": job_eta(active_jobs[job_id])}
 
     # Check completed jobs
     if job_id in completed_jobs:
@@ -532,74 +2450,1276 @@ async def get_job_status(job_id: str):
     raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
 
 @app.get("/files")
-async def list_files():
-    """List all available processed files (MKV and MP4)."""
+async def list_files(request: Request):
+    """
+    List all available processed files (MKV and MP4).
+    The listing is versioned by the file index and the name, size and mtime of
+    every listed file, so unchanged listings are answered from cache (or with
+    304) while outputs that grow in place still show their current size.
+    """
     try:
-        files = []
-        # Look for both MKV and MP4 files
-        for file_path in STREAM_DIR.glob("*.mkv"):
-            stat = file_path.stat()
-            files.append({
-                "filename": file_path.name,
-                "format": "mkv",
-                "size_mb": round(stat.st_size / (1024 * 1024), 2),
-                "modified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                "stream_url": f"/stream/{file_path.name}",
-                "download_url": f"/download/{file_path.name}"
-            })
-
-        for file_path in STREAM_DIR.glob("*.mp4"):
-            stat = file_path.stat()
-            files.append({
-                "filename": file_path.name,
-                "format": "mp4",
-                "size_mb": round(stat.st_size / (1024 * 1024), 2),
-                "modified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                "stream_url": f"/stream/{file_path.name}",
-                "download_url": f"/download/{file_path.name}"
-            })
-
-        return {
-            "count": len(files),
-            "files": sorted(files, key=lambda x: x["modified"], reverse=True)
-        }
+        version = f"{stream_files_signature()}-{file_index_version}"
+        return cached_json_response(request, "files", version, build_file_index)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing files: {str(e)}")
 
+@app.get("/files/{filename}/info")
+async def file_info(filename: str):
+    """Duration, streams, bitrates and track languages of a processed file (probed once, then cached)."""
+    file_path = resolve_output_file(filename)
+    try:
+        info = await probe_output(file_path)
+    except (OSError, RuntimeError, ValueError) as e:
+        raise HTTPException(status_code=500, detail=f"Error probing file: {e}")
+    return {"filename": filename, **info}
 
-@app.get("/download/{filename}")
-async def download_file(filename: str):
+@app.get("/files/{filename}/previews")
+async def file_previews(filename: str):
     """
-    Download a processed file with proper download headers.
-    
-    Example:
-    ```
-    curl -O "https://your-space.hf.space/download/clip_13141002.mp4"
-    wget "https://your-space.hf.space/download/clip_13141002.mkv"
-    ```
+    Thumbnail and seek-preview sprite manifest for an MP4.
+    Generated after the mux for jobs with previews enabled, or on first request.
+    """
+    file_path = resolve_output_file(filename)
+    if file_path.suffix != ".mp4":
+        raise HTTPException(status_code=400, detail="Previews are only available for MP4 files")
+    try:
+        manifest = await generate_previews(file_path)
+    except (OSError, RuntimeError, ValueError) as e:
+        raise HTTPException(status_code=500, detail=f"Error generating previews: {e}")
+
+    base_url = f"/files/{quote(filename)}/previews"
+    version = f"?v={manifest['generation']}"
+    return {
+        "filename": filename,
+        "interval": manifest["interval"],
+        "width": manifest["width"],
+        "height": manifest["height"],
+        "tile": manifest["tile"],
+        "thumbnails": [{"time": thumb["time"], "url": f"{base_url}/{thumb['file']}{version}"} for thumb in manifest["thumbnails"]],
+        "sprites": [f"{base_url}/{name}{version}" for name in manifest["sprites"]],
+        "vtt": f"{base_url}/{manifest['vtt']}{version}"
+    }
+
+@app.get("/files/{filename}/previews/{asset}")
+async def file_preview_asset(filename: str, asset: str, request: Request, v: Optional[str] = None):
+    """
+    A thumbnail, sprite sheet or sprite VTT.
+    URLs carrying the current build's ?v= can be cached for good; any other
+    URL for the same name must revalidate, as a rebuild reuses the names.
+    """
+    file_path = resolve_output_file(filename)
+    if not PREVIEW_ASSET_PATTERN.match(asset):
+        raise HTTPException(status_code=400, detail="Invalid preview asset")
+    manifest = cached_previews(file_path, file_path.stat())
+    if manifest is None:
+        raise HTTPException(status_code=404, detail=f"No previews for '{filename}' yet")
+
+    asset_path = META_DIR / f"{filename}.previews" / asset
+    if not asset_path.is_file():
+        raise HTTPException(status_code=404, detail=f"Preview asset '{asset}' not found")
+    return RangeFileResponse(
+        asset_path,
+        request,
+        media_type="text/vtt" if asset.endswith(".vtt") else "image/jpeg",
+        headers={"Cache-Control": "public, max-age=31536000, immutable" if v == manifest["generation"] else "no-cache"}
+    )
+
+def stream_files_signature() -> str:
+    """Digest of the name, size and mtime of every listed output (stat only, no reads)."""
+    digest = hashlib.blake2b(digest_size=8)
+    for pattern in ("*.mkv", "*.mp4"):
+        for file_path in sorted(STREAM_DIR.glob(pattern)):
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                continue
+            digest.update(f"{file_path.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def build_file_index() -> dict:
+    """Scan STREAM_DIR and describe every processed file."""
+    files = []
+    # Look for both MKV and MP4 files
+    for file_path in STREAM_DIR.glob("*.mkv"):
+        stat = file_path.stat()
+        checksum = get_file_checksum(file_path, stat)
+        files.append({
+            "filename": file_path.name,
+            "format": "mkv",
+            "size_mb": round(stat.st_size / (1024 * 1024), 2),
+            "modified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
+            "sha256": checksum["sha256"] if checksum else None,
+            "duration": (cached_probe(file_path, stat) or {}).get("duration"),
+            "info_url": f"/files/{file_path.name}/info",
+            "stream_url": f"/stream/{file_path.name}",
+            "download_url": f"/download/{file_path.name}"
+        })
+
+    for file_path in STREAM_DIR.glob("*.mp4"):
+        stat = file_path.stat()
+        checksum = get_file_checksum(file_path, stat)
+        files.append({
+            "filename": file_path.name,
+            "format": "mp4",
+            "size_mb": round(stat.st_size / (1024 * 1024), 2),
+            "modified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
+            "sha256": checksum["sha256"] if checksum else None,
+            "duration": (cached_probe(file_path, stat) or {}).get("duration"),
+            "info_url": f"/files/{file_path.name}/info",
+            "stream_url": f"/stream/{file_path.name}",
+            "download_url": f"/download/{file_path.name}"
+        })
+
+    return {
+        "count": len(files),
+        "files": sorted(files, key=lambda x: x["modified"], reverse=True)
+    }
+
+
+def parse_range_header(value: str, size: int) -> Optional[List[tuple]]:
     """
+    Parse a Range header into sorted, merged (start, end) pairs (end inclusive).
+    Returns None when the header is malformed (it is then ignored) and an
+    empty list when no range overlaps the file (416).
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        first, dash, last = part.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and start > end:
+                    return None
+            else:
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start, end = max(0, size - suffix), size - 1
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    # Merge overlapping and adjacent ranges
+    merged: List[tuple] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class TokenBucket:
+    """
+    Byte token bucket. Reservations may overdraw it; the caller then waits
+    for the returned number of seconds, which paces it at `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def backlog_seconds(self) -> float:
+        """How long a new reservation would currently have to wait."""
+        self._refill()
+        return max(0.0, -self.tokens / self.rate)
+
+    def reserve(self, amount: int) -> float:
+        self._refill()
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+def make_bucket(mb_per_s: float) -> Optional[TokenBucket]:
+    if mb_per_s <= 0:
+        return None
+    rate = mb_per_s * 1024 * 1024
+    return TokenBucket(rate, rate * EGRESS_BURST_SECONDS)
+
+global_egress_bucket = make_bucket(EGRESS_GLOBAL_MB_PER_S)
+client_egress_buckets: Dict[str, TokenBucket] = {}
+client_connections: Dict[str, int] = {}
+
+def client_key(request: Request) -> str:
+    """
+    Identify the client a transfer is accounted to.
+    Entries left of the ones our own proxies appended are whatever the
+    client sent, so the address is taken TRUSTED_PROXY_HOPS from the right.
+    """
+    if TRUST_PROXY_HEADERS:
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if TRUSTED_PROXY_HOPS > 0 and len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+class EgressLease:
+    """An admitted transfer: holds one of the client's connection slots and paces its bytes."""
+
+    def __init__(self, client: str):
+        self.client = client
+        self.released = False
+        client_connections[client] = client_connections.get(client, 0) + 1
+        self.client_bucket = None
+        if EGRESS_CLIENT_MB_PER_S > 0:
+            self.client_bucket = client_egress_buckets.get(client)
+            if self.client_bucket is None:
+                self.client_bucket = client_egress_buckets[client] = make_bucket(EGRESS_CLIENT_MB_PER_S)
+
+    async def throttle(self, nbytes: int):
+        """Wait until `nbytes` may be sent under the global and per-client rates."""
+        wait = 0.0
+        if global_egress_bucket is not None:
+            wait = global_egress_bucket.reserve(nbytes)
+        if self.client_bucket is not None:
+            wait = max(wait, self.client_bucket.reserve(nbytes))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        client_connections[self.client] -= 1
+        if client_connections[self.client] <= 0:
+            del client_connections[self.client]
+            # Forget idle clients once their bucket has refilled
+            bucket = client_egress_buckets.get(self.client)
+            if bucket is not None and bucket.is_full():
+                del client_egress_buckets[self.client]
+
+def admit_egress(request: Request) -> EgressLease:
+    """Admit a file transfer or reject it with 429 and Retry-After."""
+    client = client_key(request)
+
+    if MAX_CONNECTIONS_PER_CLIENT > 0 and client_connections.get(client, 0) >= MAX_CONNECTIONS_PER_CLIENT:
+        metric_egress_rejections.inc(labels=("connections",))
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many concurrent transfers (limit {MAX_CONNECTIONS_PER_CLIENT} per client)",
+            headers={"Retry-After": "5"}
+        )
+
+    backlog = 0.0
+    if global_egress_bucket is not None:
+        backlog = global_egress_bucket.backlog_seconds()
+    if client in client_egress_buckets:
+        backlog = max(backlog, client_egress_buckets[client].backlog_seconds())
+    if backlog > EGRESS_MAX_WAIT_SECONDS:
+        metric_egress_rejections.inc(labels=("bandwidth",))
+        raise HTTPException(
+            status_code=429,
+            detail="Egress bandwidth limit reached",
+            headers={"Retry-After": str(math.ceil(backlog))}
+        )
+
+    return EgressLease(client)
+
+class RangeFileResponse(Response):
+    """
+    Serve a file with single/multi-range (206), HEAD and conditional request support.
+    The body is sent as SERVE_CHUNK_SIZE pread() chunks read off the event loop.
+    """
+
+    def __init__(self, path: Path, request: Request, media_type: Optional[str] = None,
+                 headers: Optional[Dict[str, str]] = None, lease: Optional[EgressLease] = None):
+        self.path = path
+        self.request = request
+        self.media_type = media_type or guess_media_type(path.name)
+        self.extra_headers = headers or {}
+        self.lease = lease
+        self.status_code = 200
+        self.background = None
+        self.init_headers()
+
+    async def __call__(self, scope, receive, send):
+        started = time.monotonic()
+        try:
+            await self._respond(scope, send)
+        finally:
+            if self.lease is not None:
+                self.lease.release()
+            seconds = time.monotonic() - started
+            metric_serve_duration.observe(seconds, (str(self.status_code),))
+            log_sampled("Served file", file=self.path.name, status=self.status_code, seconds=round(seconds, 4))
+
+        if self.background is not None:
+            await self.background()
+
+    async def _respond(self, scope, send):
+        with open(self.path, "rb", buffering=0) as file:
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
+            etag = file_etag(stat)
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+            headers = {
+                "accept-ranges": "bytes",
+                "etag": etag,
+                "last-modified": last_modified,
+                **{name.lower(): value for name, value in self.extra_headers.items()}
+            }
+            checksum = get_file_checksum(self.path, stat)
+            if checksum is not None:
+                # Digest of the whole file, so ranged readers can verify after reassembly
+                headers["digest"] = digest_header(checksum)
+            request_headers = self.request.headers
+            send_body = scope.get("method", "GET") != "HEAD"
+
+            if not_modified(request_headers, etag, stat.st_mtime):
+                await self._start(send, 304, headers)
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            ranges = None
+            range_header = request_headers.get("range")
+            if range_header and if_range_matches(request_headers.get("if-range"), etag, stat.st_mtime):
+                ranges = parse_range_header(range_header, size)
+                if ranges is not None and len(ranges) > MAX_RANGES_PER_REQUEST:
+                    ranges = None
+
+            if ranges == []:
+                headers["content-range"] = f"bytes */{size}"
+                headers["content-length"] = "0"
+                await self._start(send, 416, headers)
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            if not ranges:
+                headers["content-type"] = self.media_type
+                headers["content-length"] = str(size)
+                await self._start(send, 200, headers)
+                if send_body:
+                    await self._send_file_range(send, file, 0, size)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                headers["content-type"] = self.media_type
+                headers["content-range"] = f"bytes {start}-{end}/{size}"
+                headers["content-length"] = str(end - start + 1)
+                await self._start(send, 206, headers)
+                if send_body:
+                    await self._send_file_range(send, file, start, end - start + 1)
+            else:
+                boundary = uuid.uuid4().hex
+                part_headers = [
+                    (f"--{boundary}\r\nContent-Type: {self.media_type}\r\n"
+                     f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+                    for start, end in ranges
+                ]
+                closing = f"--{boundary}--\r\n".encode()
+                headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+                headers["content-length"] = str(
+                    sum(len(part) + (end - start + 1) + 2 for part, (start, end) in zip(part_headers, ranges))
+                    + len(closing)
+                )
+                await self._start(send, 206, headers)
+                if send_body:
+                    for part, (start, end) in zip(part_headers, ranges):
+                        await send({"type": "http.response.body", "body": part, "more_body": True})
+                        await self._send_file_range(send, file, start, end - start + 1)
+                        await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+                    await send({"type": "http.response.body", "body": closing, "more_body": True})
+
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _start(self, send, status: int, headers: Dict[str, str]):
+        self.status_code = status
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+        })
+
+    async def _send_file_range(self, send, file, offset: int, length: int):
+        """Send `length` bytes of `file` starting at `offset`."""
+        while length > 0:
+            count = min(length, SERVE_CHUNK_SIZE)
+            if self.lease is not None:
+                await self.lease.throttle(count)
+            data = await anyio.to_thread.run_sync(os.pread, file.fileno(), count, offset)
+            if not data:
+                # File shrank underneath us; the client sees a short body
+                raise RuntimeError(f"{self.path.name} truncated while serving")
+            count = len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+            metric_served_bytes.inc(count, ("file",))
+            offset += count
+            length -= count
+
+def guess_media_type(filename: str) -> str:
+    """Content type for a served output file."""
+    if filename.endswith(".mkv"):
+        return "video/x-matroska"
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+def file_etag(stat: os.stat_result) -> str:
+    """Strong validator derived from inode, size and modification time."""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if if_none_match is None:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def not_modified(request_headers, etag: str, mtime: float) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since against the current file."""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def if_range_matches(if_range: Optional[str], etag: str, mtime: float) -> bool:
+    """True when the Range header should be honoured under If-Range."""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    try:
+        return int(mtime) == int(parsedate_to_datetime(if_range).timestamp())
+    except (TypeError, ValueError):
+        return False
+
+def resolve_output_file(filename: str) -> Path:
+    """Map a requested name to a file in STREAM_DIR, rejecting traversal and missing files."""
     # Security: prevent directory traversal
     if ".." in filename or "/" in filename or "\\" in filename:
         raise HTTPException(status_code=400, detail="Invalid filename")
-    
+
     file_path = STREAM_DIR / filename
-    
-    # Check if file exists
-    if not file_path.exists() or not file_path.is_file():
+    if not file_path.is_file():
         raise HTTPException(status_code=404, detail=f"File '{filename}' not found")
+    return file_path
+
+@app.api_route("/stream/{filename}", methods=["GET", "HEAD"])
+async def stream_file(filename: str, request: Request):
+    """
+    Stream a processed file for playback.
+    Supports byte ranges (seeking), HEAD and conditional requests.
+    """
+    file_path = resolve_output_file(filename)
+    return RangeFileResponse(file_path, request, lease=admit_egress(request))
+
+@app.api_route("/download/{filename}", methods=["GET", "HEAD"])
+async def download_file(filename: str, request: Request):
+    """
+    Download a processed file with proper download headers.
+    Interrupted downloads can resume with a Range request.
     
+    Example:
+    ```
+    curl -O "https://your-space.hf.space/download/clip_13141002.mp4"
+    wget -c "https://your-space.hf.space/download/clip_13141002.mkv"
+    ```
+    """
+    file_path = resolve_output_file(filename)
+
     # Return file with download headers
-    return FileResponse(
-        path=str(file_path),
-        filename=filename,
+    return RangeFileResponse(
+        file_path,
+        request,
         media_type="application/octet-stream",
-        headers={
-            "Content-Disposition": f'attachment; filename="{filename}"',
-            "Content-Length": str(file_path.stat().st_size)
-        }
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        lease=admit_egress(request)
     )
 
 
+async def follow_growing_file(job_id: str, lease: EgressLease):
+    """
+    Yield a live job's output as it is written.
+    At end of file the generator waits for more bytes while the mux is still
+    running, and stops once the job has moved past it. While the job is
+    queued or downloading it just waits: LIVE_IDLE_TIMEOUT only counts once
+    the mux has started.
+    """
+    file = None
+    offset = 0
+    idle_since = None
+    try:
+        while True:
+            job = active_jobs.get(job_id) or completed_jobs.get(job_id)
+            if job is None:
+                return
+            still_writing = job["status"] in ("queued", "processing", "converting")
+
+            if file is None and job.get("live_file") and job["status"] != "queued":
+                try:
+                    file = open(STREAM_DIR / job["live_file"], "rb", buffering=0)
+                except FileNotFoundError:
+                    pass
+
+            data = b""
+            if file is not None:
+                data = await anyio.to_thread.run_sync(os.pread, file.fileno(), SERVE_CHUNK_SIZE, offset)
+
+            if data:
+                offset += len(data)
+                idle_since = time.monotonic()
+                await lease.throttle(len(data))
+                metric_served_bytes.inc(len(data), ("live",))
+                yield data
+                continue
+
+            # Nothing new: finished once the writer is done, otherwise wait for it
+            if not still_writing:
+                return
+            if idle_since is None and (file is not None or job["status"] == "converting"):
+                idle_since = time.monotonic()
+            if idle_since is not None and time.monotonic() - idle_since > LIVE_IDLE_TIMEOUT:
+                return
+            await asyncio.sleep(LIVE_POLL_INTERVAL)
+    finally:
+        lease.release()
+        if file is not None:
+            file.close()
+
+@app.get("/live/{job_id}")
+async def live_stream(job_id: str, request: Request):
+    """
+    Watch a job's MP4 while it is still being muxed (requires "live": true).
+    The response follows the growing fragmented MP4 and ends when the mux
+    finishes; afterwards the file is available via /stream as usual.
+    """
+    job = active_jobs.get(job_id) or completed_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if not job["request"].get("live"):
+        raise HTTPException(status_code=400, detail="Job was not submitted with live=true")
+    if job["status"] in ("error", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+
+    lease = admit_egress(request)
+    return StreamingResponse(
+        follow_growing_file(job_id, lease),
+        media_type="video/mp4",
+        headers={"Cache-Control": "no-store"},
+        # Also frees the slot if the client leaves before the first chunk
+        background=BackgroundTask(lease.release)
+    )
+
+def read_box_header(file, offset: int, end: int) -> Optional[tuple]:
+    """Read the MP4 box header at `offset`; returns (type, header_size, box_size)."""
+    if offset + 8 > end:
+        return None
+    header = os.pread(file.fileno(), 16, offset)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack(">I4s", header[:8])
+    header_size = 8
+    if size == 1:
+        if len(header) < 16:
+            return None
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        size = end - offset
+    if size < header_size:
+        return None
+    return box_type.decode("latin-1"), header_size, size
+
+def iter_boxes(file, start: int, end: int):
+    """Yield (type, offset, header_size, size) for the boxes between start and end."""
+    offset = start
+    while True:
+        header = read_box_header(file, offset, end)
+        if header is None:
+            return
+        box_type, header_size, size = header
+        yield box_type, offset, header_size, size
+        offset += size
+
+def read_box_payload(file, offset: int, header_size: int, size: int) -> bytes:
+    return os.pread(file.fileno(), size - header_size, offset + header_size)
+
+def child_boxes(payload: bytes):
+    """Yield (type, body) for boxes nested in an in-memory container payload."""
+    offset = 0
+    while offset + 8 <= len(payload):
+        size, box_type = struct.unpack(">I4s", payload[offset:offset + 8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", payload[offset + 8:offset + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = len(payload) - offset
+        if size < header_size:
+            return
+        yield box_type.decode("latin-1"), payload[offset + header_size:offset + size]
+        offset += size
+
+def parse_moov_tracks(moov: bytes) -> Dict[int, dict]:
+    """Map track_ID -> {"timescale", "handler", "default_duration"} from a moov payload."""
+    tracks: Dict[int, dict] = {}
+    trex_defaults: Dict[int, int] = {}
+    for box_type, body in child_boxes(moov):
+        if box_type == "trak":
+            track = {"timescale": None, "handler": None, "default_duration": 0}
+            track_id = None
+            for trak_type, trak_body in child_boxes(body):
+                if trak_type == "tkhd":
+                    version = trak_body[0]
+                    track_id = struct.unpack(">I", trak_body[20:24] if version == 1 else trak_body[12:16])[0]
+                elif trak_type == "mdia":
+                    for mdia_type, mdia_body in child_boxes(trak_body):
+                        if mdia_type == "mdhd":
+                            version = mdia_body[0]
+                            track["timescale"] = struct.unpack(">I", mdia_body[20:24] if version == 1 else mdia_body[12:16])[0]
+                        elif mdia_type == "hdlr":
+                            track["handler"] = mdia_body[8:12].decode("latin-1")
+            if track_id is not None:
+                tracks[track_id] = track
+        elif box_type == "mvex":
+            for mvex_type, mvex_body in child_boxes(body):
+                if mvex_type == "trex":
+                    track_id, _, default_duration = struct.unpack(">III", mvex_body[4:16])
+                    trex_defaults[track_id] = default_duration
+    for track_id, default_duration in trex_defaults.items():
+        if track_id in tracks:
+            tracks[track_id]["default_duration"] = default_duration
+    return tracks
+
+def fragment_duration(moof: bytes, track_id: int, default_duration: int) -> Optional[int]:
+    """Sum the sample durations of `track_id` in a moof payload, in track timescale units."""
+    for box_type, body in child_boxes(moof):
+        if box_type != "traf":
+            continue
+        duration = None
+        sample_default = default_duration
+        for traf_type, traf_body in child_boxes(body):
+            if traf_type == "tfhd":
+                flags = int.from_bytes(traf_body[1:4], "big")
+                if struct.unpack(">I", traf_body[4:8])[0] != track_id:
+                    break
+                position = 8
+                if flags & 0x000001:
+                    position += 8
+                if flags & 0x000002:
+                    position += 4
+                if flags & 0x000008:
+                    sample_default = struct.unpack(">I", traf_body[position:position + 4])[0]
+                duration = 0
+            elif traf_type == "trun" and duration is not None:
+                flags = int.from_bytes(traf_body[1:4], "big")
+                sample_count = struct.unpack(">I", traf_body[4:8])[0]
+                position = 8
+                if flags & 0x000001:
+                    position += 4
+                if flags & 0x000004:
+                    position += 4
+                if not flags & 0x000100:
+                    duration += sample_count * sample_default
+                    continue
+                stride = 4 * bin(flags & 0x000F00).count("1")
+                for _ in range(sample_count):
+                    duration += struct.unpack(">I", traf_body[position:position + 4])[0]
+                    position += stride
+        if duration is not None:
+            return duration
+    return None
+
+def build_hls_index(path: Path) -> dict:
+    """
+    Compute byte-range segments for a fragmented MP4.
+    Uses a top-level sidx when present, otherwise walks the moof boxes and
+    groups consecutive fragments into segments of about HLS_SEGMENT_SECONDS.
+    Raises ValueError for MP4s that are not fragmented.
+    """
+    with open(path, "rb", buffering=0) as file:
+        stat = os.fstat(file.fileno())
+        end = stat.st_size
+        moov = None
+        init_end = None
+        sidx = None
+        fragments = []  # (offset, length, duration in track timescale)
+        current = None
+
+        tracks: Dict[int, dict] = {}
+        reference_track = None
+
+        for box_type, offset, header_size, size in iter_boxes(file, 0, end):
+            if box_type == "moov":
+                moov = read_box_payload(file, offset, header_size, size)
+                init_end = offset + size
+                tracks = parse_moov_tracks(moov)
+                video_tracks = [tid for tid, track in tracks.items() if track["handler"] == "vide"]
+                reference_track = (video_tracks or sorted(tracks))[0] if tracks else None
+            elif box_type == "sidx" and sidx is None and moov is not None:
+                sidx = (offset, header_size, size)
+            elif box_type == "moof":
+                if moov is None or reference_track is None:
+                    raise ValueError("moof before moov")
+                if sidx is not None:
+                    break
+                if current is not None:
+                    fragments.append(current)
+                payload = read_box_payload(file, offset, header_size, size)
+                duration = fragment_duration(payload, reference_track, tracks[reference_track]["default_duration"])
+                current = [offset, size, duration or 0]
+            elif current is not None:
+                # mdat and any trailing boxes belong to the preceding fragment
+                current[1] = offset + size - current[0]
+        if current is not None:
+            fragments.append(current)
+
+        if moov is None:
+            raise ValueError("No moov box found")
+
+        if sidx is not None:
+            offset, header_size, size = sidx
+            body = read_box_payload(file, offset, header_size, size)
+            version = body[0]
+            timescale = struct.unpack(">I", body[8:12])[0]
+            if version == 0:
+                first_offset = struct.unpack(">I", body[16:20])[0]
+                position = 20
+            else:
+                first_offset = struct.unpack(">Q", body[20:28])[0]
+                position = 28
+            reference_count = struct.unpack(">H", body[position + 2:position + 4])[0]
+            position += 4
+            segment_offset = offset + size + first_offset
+            fragments = []
+            for _ in range(reference_count):
+                reference, subsegment_duration = struct.unpack(">II", body[position:position + 8])
+                referenced_size = reference & 0x7FFFFFFF
+                fragments.append([segment_offset, referenced_size, subsegment_duration])
+                segment_offset += referenced_size
+                position += 12
+        else:
+            timescale = tracks[reference_track]["timescale"] if reference_track in tracks else None
+
+        if not fragments:
+            raise ValueError("MP4 is not fragmented; only fragmented MP4s can be served as byte-range HLS")
+        if not timescale:
+            raise ValueError("Could not determine the reference track timescale")
+
+    # Merge consecutive fragments into segments of roughly the target duration
+    segments = []
+    for offset, length, duration in fragments:
+        seconds = duration / timescale
+        if segments and segments[-1][2] + seconds <= HLS_SEGMENT_SECONDS and segments[-1][0] + segments[-1][1] == offset:
+            segments[-1][1] += length
+            segments[-1][2] += seconds
+        else:
+            segments.append([offset, length, seconds])
+
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "init": [0, init_end],
+        "segments": [[offset, length, round(seconds, 6)] for offset, length, seconds in segments]
+    }
+
+def load_hls_index(path: Path) -> dict:
+    """Return the cached segment index for `path`, rebuilding it if the file changed."""
+    stat = path.stat()
+    index_file = META_DIR / f"{path.name}.hls.json"
+    try:
+        index = json.loads(index_file.read_text())
+        if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = build_hls_index(path)
+    META_DIR.mkdir(parents=True, exist_ok=True)
+    temp_file = index_file.with_suffix(".tmp")
+    temp_file.write_text(json.dumps(index))
+    temp_file.replace(index_file)
+    return index
+
+@app.get("/hls/{filename}.m3u8")
+async def hls_playlist(filename: str):
+    """
+    HLS playlist over an existing fragmented MP4 using byte-range segments.
+    Segments point straight into /stream/{filename}; nothing is re-encoded or
+    copied. The segment index is computed once and cached next to the file.
+    Only fragmented MP4s qualify: outputs of jobs submitted with hls=true or
+    live=true. Default outputs are muxed with faststart (one moov, no
+    fragments) and get 422.
+    """
+    file_path = resolve_output_file(filename)
+    if file_path.suffix != ".mp4":
+        raise HTTPException(status_code=400, detail="HLS playlists are only available for MP4 files")
+
+    try:
+        index = await anyio.to_thread.run_sync(load_hls_index, file_path)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=422,
+            detail=f"{e}; submit the job with \"hls\": true (or \"live\": true) to get one"
+        )
+
+    media_uri = f"/stream/{quote(filename)}"
+    init_offset, init_length = index["init"]
+    target_duration = max(1, math.ceil(max(seconds for _, _, seconds in index["segments"])))
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        f'#EXT-X-MAP:URI="{media_uri}",BYTERANGE="{init_length}@{init_offset}"'
+    ]
+    for offset, length, seconds in index["segments"]:
+        lines.append(f"#EXTINF:{seconds:.6f},")
+        lines.append(f"#EXT-X-BYTERANGE:{length}@{offset}")
+        lines.append(media_uri)
+    lines.append("#EXT-X-ENDLIST")
+
+    return Response(
+        content="\n".join(lines) + "\n",
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+def dos_datetime(mtime: float) -> tuple:
+    """ZIP (DOS) time and date fields for a UTC timestamp."""
+    t = time.gmtime(max(mtime, 315532800))  # DOS dates start in 1980
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def file_crc32(path: Path, stat: os.stat_result) -> int:
+    """CRC-32 of a file, cached per inode/size/mtime."""
+    cache_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if cache_key not in crc32_cache and get_file_checksum(path, stat) is None:
+        crc = 0
+        with open(path, "rb", buffering=0) as f:
+            while chunk := f.read(SERVE_CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+        crc32_cache[cache_key] = crc
+    return crc32_cache[cache_key]
+
+class BundleLayout:
+    """
+    Byte-exact layout of a stored (uncompressed) ZIP or TAR of output files.
+    The layout depends only on the file list, names, sizes and mtimes, so
+    any byte range of it can be regenerated to resume an interrupted
+    transfer. Pieces are (length, kind, value) where kind is "bytes",
+    "file" (path, stat) or "lazy" (callable returning bytes, for ZIP parts
+    that need CRCs).
+    """
+
+    def __init__(self, entries: List[tuple], archive_format: str):
+        self.entries = entries  # (name, path, stat)
+        self.format = archive_format
+        self.pieces: List[tuple] = []
+        if archive_format == "zip":
+            self._build_zip()
+        else:
+            self._build_tar()
+        self.size = sum(piece[0] for piece in self.pieces)
+
+        identity = hashlib.sha256(archive_format.encode())
+        for name, _, stat in entries:
+            identity.update(f"{name}\0{stat.st_ino}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        self.digest = identity.hexdigest()[:32]
+        self.etag = f'"bundle-{self.digest}"'
+
+    def _build_tar(self):
+        for name, path, stat in self.entries:
+            info = tarfile.TarInfo(name)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            header = info.tobuf(format=tarfile.PAX_FORMAT)
+            self.pieces.append((len(header), "bytes", header))
+            self.pieces.append((stat.st_size, "file", (path, stat)))
+            padding = -stat.st_size % tarfile.BLOCKSIZE
+            if padding:
+                self.pieces.append((padding, "bytes", b"\0" * padding))
+        self.pieces.append((2 * tarfile.BLOCKSIZE, "bytes", b"\0" * (2 * tarfile.BLOCKSIZE)))
+
+    def _build_zip(self):
+        offset = 0
+        central_entries = []
+        for name, path, stat in self.entries:
+            encoded_name = name.encode("utf-8")
+            size = stat.st_size
+            zip64 = size >= 0xFFFFFFFF or offset >= 0xFFFFFFFF
+            dos_time, dos_date = dos_datetime(stat.st_mtime)
+            version = 45 if zip64 else 20
+            flags = 0x0808  # CRC in data descriptor, UTF-8 names
+
+            extra = struct.pack("<HHQQ", 0x0001, 16, size, size) if zip64 else b""
+            local_header = struct.pack(
+                "<IHHHHHIIIHH", 0x04034B50, version, flags, 0, dos_time, dos_date,
+                0, 0xFFFFFFFF if zip64 else size, 0xFFFFFFFF if zip64 else size,
+                len(encoded_name), len(extra)
+            ) + encoded_name + extra
+            descriptor_size = 24 if zip64 else 16
+
+            self.pieces.append((len(local_header), "bytes", local_header))
+            self.pieces.append((size, "file", (path, stat)))
+            self.pieces.append((descriptor_size, "lazy", lambda path=path, stat=stat, zip64=zip64: (
+                struct.pack("<IIQQ", 0x08074B50, file_crc32(path, stat), stat.st_size, stat.st_size) if zip64
+                else struct.pack("<IIII", 0x08074B50, file_crc32(path, stat), stat.st_size, stat.st_size)
+            )))
+            central_entries.append((encoded_name, path, stat, offset, zip64, dos_time, dos_date))
+            offset += len(local_header) + size + descriptor_size
+
+        central_offset = offset
+        central_size = sum(46 + len(entry[0]) + (28 if entry[4] else 0) for entry in central_entries)
+        needs_zip64_end = (
+            central_offset >= 0xFFFFFFFF or central_size >= 0xFFFFFFFF
+            or len(central_entries) >= 0xFFFF or any(entry[4] for entry in central_entries)
+        )
+        end_size = 22 + (56 + 20 if needs_zip64_end else 0)
+
+        def build_central_directory() -> bytes:
+            parts = []
+            for encoded_name, path, stat, local_offset, zip64, dos_time, dos_date in central_entries:
+                version = 45 if zip64 else 20
+                extra = struct.pack("<HHQQQ", 0x0001, 24, stat.st_size, stat.st_size, local_offset) if zip64 else b""
+                parts.append(struct.pack(
+                    "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | version, version, 0x0808, 0,
+                    dos_time, dos_date, file_crc32(path, stat),
+                    0xFFFFFFFF if zip64 else stat.st_size, 0xFFFFFFFF if zip64 else stat.st_size,
+                    len(encoded_name), len(extra), 0, 0, 0, 0o100644 << 16,
+                    0xFFFFFFFF if zip64 else local_offset
+                ) + encoded_name + extra)
+
+            count = len(central_entries)
+            if needs_zip64_end:
+                zip64_end_offset = central_offset + central_size
+                parts.append(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0,
+                                         count, count, central_size, central_offset))
+                parts.append(struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1))
+                parts.append(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, 0xFFFF, 0xFFFF,
+                                         0xFFFFFFFF, 0xFFFFFFFF, 0))
+            else:
+                parts.append(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, count, count,
+                                         central_size, central_offset, 0))
+            return b"".join(parts)
+
+        self.pieces.append((central_size + end_size, "lazy", build_central_directory))
+
+    async def iter_range(self, start: int, end: int, lease: Optional[EgressLease] = None):
+        """Yield the archive bytes from start to end (inclusive)."""
+        try:
+            position = 0
+            for length, kind, value in self.pieces:
+                piece_start, piece_end = position, position + length - 1
+                position += length
+                if piece_end < start or length == 0:
+                    continue
+                if piece_start > end:
+                    return
+                first = max(start, piece_start) - piece_start
+                last = min(end, piece_end) - piece_start
+
+                if kind == "file":
+                    path, stat = value
+                    # A fully streamed file yields its CRC for free
+                    whole = first == 0 and last == length - 1
+                    cache_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    crc = 0
+                    with open(path, "rb", buffering=0) as file:
+                        offset = first
+                        while offset <= last:
+                            count = min(SERVE_CHUNK_SIZE, last - offset + 1)
+                            data = await anyio.to_thread.run_sync(os.pread, file.fileno(), count, offset)
+                            if len(data) != count:
+                                raise RuntimeError(f"{path.name} changed while bundling")
+                            if whole and self.format == "zip":
+                                crc = zlib.crc32(data, crc)
+                            offset += count
+                            if lease is not None:
+                                await lease.throttle(count)
+                            metric_served_bytes.inc(count, ("bundle",))
+                            yield data
+                    if whole and self.format == "zip":
+                        crc32_cache[cache_key] = crc
+                else:
+                    data = value if kind == "bytes" else await anyio.to_thread.run_sync(value)
+                    metric_served_bytes.inc(last - first + 1, ("bundle",))
+                    yield data[first:last + 1]
+        finally:
+            if lease is not None:
+                lease.release()
+
+class BundleRequest(BaseModel):
+    filenames: Optional[List[str]] = Field(default=None, description="Output files to include")
+    job_ids: Optional[List[str]] = Field(default=None, description="Include the output file of each of these jobs")
+    format: str = Field(default="zip", pattern="^(zip|tar)$", description="Archive format: zip or tar (both uncompressed)")
+
+@app.post("/bundle")
+async def bundle_files(bundle: BundleRequest, request: Request):
+    """
+    Stream several outputs as one uncompressed ZIP or TAR.
+
+    The archive is generated on the fly with constant memory and no temp
+    file. Its layout is deterministic for a given file list, so an
+    interrupted transfer can be resumed by repeating the request with a
+    Range header (and If-Range set to the returned ETag).
+    """
+    names: List[str] = list(bundle.filenames or [])
+    missing_jobs = []
+    for job_id in bundle.job_ids or []:
+        job = completed_jobs.get(job_id) or active_jobs.get(job_id)
+        if job is None or not job.get("filename"):
+            missing_jobs.append(job_id)
+        else:
+            names.append(job["filename"])
+    if missing_jobs:
+        raise HTTPException(status_code=404, detail=f"Jobs without an output file: {missing_jobs}")
+    if not names:
+        raise HTTPException(status_code=400, detail="Provide filenames and/or job_ids")
+    if len(names) > MAX_BUNDLE_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BUNDLE_FILES} files per bundle")
+
+    entries = []
+    seen = set()
+    for name in names:
+        if name in seen:
+            continue
+        seen.add(name)
+        path = resolve_output_file(name)
+        entries.append((name, path, path.stat()))
+
+    layout = BundleLayout(entries, bundle.format)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": layout.etag,
+        "Content-Disposition": f'attachment; filename="bundle-{layout.digest[:12]}.{bundle.format}"'
+    }
+    media_type = "application/zip" if bundle.format == "zip" else "application/x-tar"
+
+    start, end, status = 0, layout.size - 1, 200
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", layout.etag) == layout.etag:
+        ranges = parse_range_header(range_header, layout.size)
+        if ranges == []:
+            raise HTTPException(status_code=416, detail="Range not satisfiable",
+                                headers={"Content-Range": f"bytes */{layout.size}"})
+        if ranges:
+            # Only the overall span is served for multi-range requests
+            start, end, status = ranges[0][0], ranges[-1][1], 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{layout.size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    lease = admit_egress(request)
+    return StreamingResponse(
+        layout.iter_range(start, end, lease),
+        status_code=status,
+        media_type=media_type,
+        headers=headers,
+        # The body releases the lease itself (also when it fails); this
+        # covers clients that leave before the first chunk
+        background=BackgroundTask(lease.release)
+    )
+
+# Admin profiling. Off unless ADMIN_TOKEN is set; callers send it in the
+# X-Admin-Token header.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+TRACEMALLOC_FRAMES = int(os.environ.get("TRACEMALLOC_FRAMES", "10"))
+stack_sampler: Optional["StackSampler"] = None
+memory_baseline: Optional[tracemalloc.Snapshot] = None
+
+def require_admin(request: Request):
+    """Reject requests without the admin token; hide the endpoints when none is configured."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+class StackSampler:
+    """
+    Statistical profiler: samples every thread's stack at a fixed interval
+    and counts identical stacks. Output is in collapsed format (one
+    "thread;outer;...;inner count" line per stack), which flamegraph.pl and
+    speedscope read directly. An idle event loop shows up under select().
+    """
+
+    def __init__(self, seconds: float, interval: float):
+        self.seconds = seconds
+        self.interval = interval
+        self.counts: collections.Counter = collections.Counter()
+        self.samples = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        deadline = self.started + self.seconds
+        own_ident = threading.get_ident()
+        while time.monotonic() < deadline and not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+        self.finished = time.monotonic()
+
+    @property
+    def running(self) -> bool:
+        return self.finished is None
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def status(self) -> dict:
+        return {
+            "status": "running" if self.running else "finished",
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "elapsed": round((self.finished or time.monotonic()) - self.started, 3),
+            "samples": self.samples,
+            "stacks": len(self.counts)
+        }
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+def tracked_container_sizes() -> dict:
+    """Entry counts of the in-memory stores that grow with traffic."""
+    return {
+        "active_jobs": len(active_jobs),
+        "completed_jobs": len(completed_jobs),
+        "queued_requests": len(queued_requests),
+        "job_fingerprints": len(job_fingerprints),
+        "batches": len(batches),
+        "host_stats": len(host_stats),
+        "response_cache": len(response_cache),
+        "file_checksums": len(file_checksums),
+        "probe_cache": len(probe_cache),
+        "finished_spans": len(finished_spans),
+        "job_spans": len(job_spans),
+        "stage_spans": len(stage_spans),
+        "log_queue": sum(handler.queue.qsize() for handler in logger.handlers
+                         if isinstance(handler, logging.handlers.QueueHandler))
+    }
+
+def diff_memory_snapshots(group_by: str, limit: int) -> dict:
+    """Snapshot traced allocations and compare them with the previous snapshot."""
+    global memory_baseline
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")
+    ))
+    previous, memory_baseline = memory_baseline, snapshot
+    if previous is None:
+        return {"top": []}
+
+    top = []
+    for stat in snapshot.compare_to(previous, group_by)[:limit]:
+        top.append({
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "size_kb": round(stat.size / 1024, 1),
+            "count_diff": stat.count_diff,
+            "count": stat.count,
+            "traceback": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+        })
+    return {"top": top}
+
+@app.post("/admin/profile/start")
+async def start_profile(request: Request, seconds: float = 30.0, interval: float = 0.01):
+    """Start sampling all thread stacks for `seconds` (one profile at a time)."""
+    global stack_sampler
+    require_admin(request)
+    if stack_sampler is not None and stack_sampler.running:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]")
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="interval must be between 0.001 and 1")
+    stack_sampler = StackSampler(seconds, interval)
+    logger.info("Profile started", extra={"fields": {"seconds": seconds, "interval": interval}})
+    return stack_sampler.status()
+
+@app.post("/admin/profile/stop")
+async def stop_profile(request: Request):
+    """Stop the running profile early."""
+    require_admin(request)
+    if stack_sampler is None:
+        raise HTTPException(status_code=404, detail="No profile has been started")
+    await anyio.to_thread.run_sync(stack_sampler.stop)
+    return stack_sampler.status()
+
+@app.get("/admin/profile")
+async def get_profile(request: Request):
+    """
+    Collapsed stacks of the current or last profile, most frequent first.
+    Pipe into flamegraph.pl or load into speedscope; progress is in the
+    X-Profile-* headers.
+    """
+    require_admin(request)
+    if stack_sampler is None:
+        raise HTTPException(status_code=404, detail="No profile has been started")
+    status = stack_sampler.status()
+    return PlainTextResponse(stack_sampler.collapsed(), headers={
+        "X-Profile-Status": status["status"],
+        "X-Profile-Samples": str(status["samples"]),
+        "X-Profile-Elapsed": str(status["elapsed"])
+    })
+
+@app.post("/admin/memory/snapshot")
+async def memory_snapshot(request: Request, group_by: str = "lineno", limit: int = 25):
+    """
+    Take a tracemalloc snapshot and diff it against the previous one.
+    The first call starts tracing and returns only the baseline; call again
+    after some traffic to see where memory grew.
+    """
+    require_admin(request)
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by must be lineno, filename or traceback")
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    diff = await anyio.to_thread.run_sync(diff_memory_snapshots, group_by, max(1, limit))
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_mb": round(current / 1048576, 2),
+        "peak_traced_mb": round(peak / 1048576, 2),
+        "containers": tracked_container_sizes(),
+        **diff
+    }
+
+@app.delete("/admin/memory/snapshot")
+async def stop_memory_tracing(request: Request):
+    """Stop tracemalloc (it slows allocations down) and drop the baseline."""
+    global memory_baseline
+    require_admin(request)
+    memory_baseline = None
+    tracemalloc.stop()
+    return {"status": "stopped"}
+
 @app.get("/debug")
 async def debug_info():
     """Show detailed system and file information for debugging."""
@@ -690,7 +3810,12 @@ async def check_google_drive_credentials():
     """Check if Google Drive credentials are working properly."""
     try:
         # Check if credentials file exists
-        print(f"🔍 Current working directory: {os.getcwd()}")
+        credentials_file = None
+        possible_paths = [
+            Path("credentials.json"),
+            Path("/app/credentials.json"),
+            Path(os.getcwd()) / "credentials.json"
+        ]
 
         # List all files in current directory
         try:
@@ -721,25 +3846,15 @@ async def check_google_drive_credentials():
                 "expected_locations": [str(p) for p in possible_paths]
             }
 
-        credentials_file = None
-        possible_paths = [
-            Path("credentials.json"),
-            Path("/app/credentials.json"),
-            Path(os.getcwd()) / "credentials.json"
-        ]
-
         for path in possible_paths:
             if path.exists():
                 credentials_file = path
                 break
 
         if not credentials_file:
-            # Print debug info to server logs
-            print("⚠️  credentials.json not found in any expected location.")
-            print("   Please ensure credentials.json is uploaded to the same directory as app.py")
-            print("   Expected locations:")
-            for path in possible_paths:
-                print(f"     - {path}")
+            logger.warning("credentials.json not found; upload it next to app.py", extra={"fields": {
+                "expected_locations": [str(path) for path in possible_paths]
+            }})
 
             return {
                 "status": "error",
@@ -847,49 +3962,30 @@ async def check_google_drive_credentials():
 
 @app.delete("/jobs/{job_id}")
 async def cancel_job(job_id: str):
-    """Cancel an active job (if possible)."""
+    """Cancel an active job, stopping its running child process if it has one."""
     if job_id in active_jobs:
-        # Note: Actual process cancellation would require tracking the subprocess PID
+        # Queued jobs are simply dropped from the scheduler
+        queued_requests.pop(job_id, None)
+        # Running jobs: cancelling the task terminates the child, and the
+        # task's cleanup frees the slot and the bandwidth share
+        if job_id in running_tasks:
+            running_tasks[job_id].cancel()
         active_jobs[job_id]["status"] = "cancelled"
         completed_jobs[job_id] = active_jobs[job_id]
         del active_jobs[job_id]
+        metric_jobs_finished.inc(labels=("cancelled",))
+        if job_id not in running_tasks:
+            # Running jobs close their timings and span when their task ends
+            finish_job_timings(completed_jobs[job_id])
         return {"message": f"Job {job_id} cancelled"}
 
     raise HTTPException(status_code=404, detail=f"Job {job_id} not found or already completed")
 
 if __name__ == "__main__":
-    print("🎥 N_m3u8DL-RE DRM Processor - Enhanced FastAPI Server")
-    print("=" * 60)
-    print(f"Stream directory: {STREAM_DIR}")
-    print("Server starting on port 7860...")
-    print()
-    print("📡 API Endpoints:")
-    print("  • POST /process           - Trigger file processing via API")
-    print("  • GET  /jobs              - List all jobs")
-    print("  • GET  /jobs/{job_id}     - Check job status")
-    print("  • GET  /files             - List all processed files")
-    print("  • GET  /stream/{filename} - Stream/access file (playback)")
-    print("  • GET  /download/{filename} - Download file")
-    print("  • GET  /health            - Health check")
-    print()
-    print("🔄 Conversion Info:")
-    print("  • MKV files are automatically converted to MP4 after processing")
-    print("  • Video and audio streams are copied (no re-encoding) for speed")
-    print("  • Subtitle streams are excluded (MP4 compatibility)")
-    print("  • Optimized for streaming with faststart flag")
-    print("  ⚠️  Note: Subtitles are not included in MP4 output files")
-    print()
-    print("💡 Example API calls:")
-    print()
-    print("  Single key:")
-    print('    curl -X POST "http://localhost:7860/process" \\')
-    print('      -H "Content-Type: application/json" \\')
-    print('      -d \'{"url":"https://...", "save_name":"clip", "key":"...", "binary_merge":true}\'')
-    print()
-    print("  Multiple keys:")
-    print('    curl -X POST "http://localhost:7860/process" \\')
-    print('      -H "Content-Type: application/json" \\')
-    print('      -d \'{"url":"https://...", "save_name":"clip", "keys":["key1","key2","key3"], "binary_merge":true}\'')
-    print()
-
-    uvicorn.run(app, host="0.0.0.0", port=7860, log_level="info")
\ No newline at end of file
+    logger.info("Starting N_m3u8DL-RE DRM Processor", extra={"fields": {
+        "stream_dir": str(STREAM_DIR),
+        "port": 7860,
+        "log_level": LOG_LEVEL
+    }})
+
+    uvicorn.run(app, host="0.0.0.0", port=7860, log_level=LOG_LEVEL.lower())
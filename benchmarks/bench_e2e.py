@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+End-to-end /process benchmark against the synthetic origin
+Starts synthetic_origin.py and the app, submits jobs for the generated
+HLS and DASH streams and waits for them to finish through the real
+N_m3u8DL-RE and ffmpeg (or whatever N_M3U8DL_RE_PATH/FFMPEG_PATH point to).
+
+The content is clear, so jobs carry a dummy key only to pass validation.
+Origin impairments (latency, bandwidth, errors) take the same options as
+synthetic_origin.py, and the run is repeatable for a given --seed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from common import latency_summary, start_server
+from synthetic_origin import add_arguments
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+ORIGIN_SCRIPT = Path(__file__).resolve().parent / "synthetic_origin.py"
+DUMMY_KEY = "00000000000000000000000000000000:00000000000000000000000000000000"
+MANIFESTS = {"hls": "hls/index.m3u8", "dash": "dash/manifest.mpd"}
+ORIGIN_ARGUMENTS = (
+    "duration", "segments", "segment_seconds", "bitrate_kbps", "resolution", "latency_ms", "jitter_ms",
+    "bandwidth_mbps", "error_rate", "error_mode", "errors_on", "seed", "cache_dir", "ffmpeg"
+)
+
+
+def start_origin(args):
+    """Run the origin as a child process and wait until it serves (content generation included)."""
+    command = [sys.executable, str(ORIGIN_SCRIPT), "--port", str(args.origin_port)]
+    for name in ORIGIN_ARGUMENTS:
+        value = getattr(args, name)
+        if value is not None:
+            command += [f"--{name.replace('_', '-')}", str(value)]
+    origin = subprocess.Popen(command)
+
+    async def wait_ready():
+        deadline = time.monotonic() + 600
+        async with aiohttp.ClientSession() as session:
+            while time.monotonic() < deadline:
+                if origin.poll() is not None:
+                    raise RuntimeError(f"Origin exited with code {origin.returncode}")
+                try:
+                    async with session.get(f"http://127.0.0.1:{args.origin_port}/_stats") as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.5)
+        raise TimeoutError("Origin did not come up")
+
+    asyncio.run(wait_ready())
+    return origin
+
+
+async def run_jobs(args):
+    base_url = f"http://127.0.0.1:{args.port}"
+    origin_url = f"http://127.0.0.1:{args.origin_port}"
+    formats = args.formats.split(",")
+    jobs = [
+        {
+            "url": f"{origin_url}/{MANIFESTS[formats[index % len(formats)]]}",
+            "save_name": f"e2e_{formats[index % len(formats)]}_{index}",
+            "keys": [DUMMY_KEY],
+            "force": True
+        }
+        for index in range(args.jobs)
+    ]
+
+    async with aiohttp.ClientSession() as session:
+        started = time.monotonic()
+        async with session.post(f"{base_url}/process/batch", json={"jobs": jobs}) as response:
+            job_ids = (await response.json())["job_ids"]
+
+        # Poll the way a client would, asking only for what changed
+        records = {}
+        changed_since = 0
+        while len([job for job in records.values() if job["status"] in ("completed", "error", "cancelled")]) < len(job_ids):
+            await asyncio.sleep(0.5)
+            async with session.post(f"{base_url}/jobs/status", json={
+                "job_ids": job_ids, "changed_since": changed_since
+            }) as response:
+                body = await response.json()
+            records.update(body["jobs"])
+            changed_since = body.get("version", changed_since)
+            if time.monotonic() - started > args.timeout:
+                raise TimeoutError(f"Jobs still running after {args.timeout}s")
+        elapsed = time.monotonic() - started
+
+        async with session.get(f"{origin_url}/_stats") as response:
+            origin_stats = await response.json()
+
+    results = {"elapsed_s": round(elapsed, 2), "formats": {}, "origin": origin_stats}
+    output_bytes = 0
+    for kind in formats:
+        selected = [records[job_id] for job_id, job in zip(job_ids, jobs) if f"/{kind}/" in job["url"]]
+        completed = [job for job in selected if job["status"] == "completed"]
+        stages = {}
+        for job in completed:
+            for stage, entry in job["timings"]["stages"].items():
+                stages.setdefault(stage, []).append(entry["seconds"])
+        size = sum(job.get("file_size_mb") or 0 for job in completed)
+        output_bytes += size * 1048576
+        results["formats"][kind] = {
+            "jobs": len(selected),
+            "completed": len(completed),
+            "failed": len(selected) - len(completed),
+            "errors": sorted({job.get("error") or "" for job in selected if job["status"] != "completed"}),
+            "output_mb": round(size, 1),
+            "total_ms": latency_summary([job["timings"]["total_seconds"] for job in completed]),
+            "stage_ms": {stage: latency_summary(values) for stage, values in stages.items()}
+        }
+    results["mb_per_s"] = round(output_bytes / 1048576 / elapsed, 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--jobs", type=int, default=8, help="Jobs to submit, alternating between formats")
+    parser.add_argument("--formats", default="hls,dash", help="Comma-separated: hls, dash")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=1800.0)
+    parser.add_argument("--max-failure-rate", type=float, default=0.0, help="Exit 1 if more jobs than this fail")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--origin-port", type=int, default=8091)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    origin = start_origin(args)
+    base_dir = Path(tempfile.mkdtemp(prefix="bench_e2e_"))
+    os.environ.update({
+        "APP_BASE_DIR": str(base_dir),
+        "MAX_CONCURRENT_JOBS": str(args.max_concurrent_jobs),
+        "MAX_JOBS_PER_HOST": str(args.max_concurrent_jobs),  # Every job hits the same local origin
+        "GDRIVE_UPLOAD": "0",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING")
+    })
+    sys.path.insert(0, str(REPO_DIR))
+    import app as processor
+
+    server, thread = start_server(processor.app, args.port)
+    try:
+        results = asyncio.run(run_jobs(args))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+        origin.terminate()
+        origin.wait()
+
+    results["parameters"] = {name: getattr(args, name) for name in ORIGIN_ARGUMENTS + ("jobs", "formats", "max_concurrent_jobs")}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    failed = sum(entry["failed"] for entry in results["formats"].values())
+    if failed > args.max_failure_rate * args.jobs:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Concurrent range-read benchmark for /stream
+Compares the range-aware file serving path (pread chunks, ETag/If-Range) against
+the previous StaticFiles mount on two workloads: resumed range reads that carry
+If-Range, and ETag revalidation with If-None-Match
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from common import percentile, start_server
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+async def fetch_etag(url):
+    """The ETag a client would have kept from an earlier response."""
+    async with aiohttp.ClientSession() as session:
+        async with session.head(url) as response:
+            return response.headers.get("ETag")
+
+
+async def run_clients(url, file_size, concurrency, range_bytes, duration, validator_headers):
+    """
+    Issue requests from `concurrency` workers for `duration` seconds: random range
+    reads when `range_bytes` is set, otherwise whole-file conditional GETs.
+    """
+    latencies = []
+    statuses = {}
+    useful_bytes = 0
+    deadline = time.monotonic() + duration
+
+    async def worker(session):
+        nonlocal useful_bytes
+        while time.monotonic() < deadline:
+            headers = dict(validator_headers)
+            start = 0
+            if range_bytes:
+                start = random.randrange(0, max(1, file_size - range_bytes))
+                headers["Range"] = f"bytes={start}-{start + range_bytes - 1}"
+            began = time.monotonic()
+            async with session.get(url, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+                # A server without range support sends the whole file; like a
+                # player would, stop reading once the wanted bytes have arrived
+                whole_file = response.status == 200 and range_bytes
+                received = 0
+                async for chunk in response.content.iter_chunked(256 * 1024):
+                    received += len(chunk)
+                    if whole_file and received >= start + range_bytes:
+                        response.close()
+                        break
+            latencies.append(time.monotonic() - began)
+            useful_bytes += range_bytes if range_bytes else received
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.monotonic()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    return {
+        "requests": len(latencies),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "useful_mb_per_s": round(useful_bytes / (1024 * 1024) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2)
+        },
+        "status_codes": statuses
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=512, help="Size of the served test file")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent client connections")
+    parser.add_argument("--range-kb", type=int, default=1024, help="Bytes requested per range read")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per implementation")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    base_dir = Path(tempfile.mkdtemp(prefix="bench_serving_"))
+    os.environ["APP_BASE_DIR"] = str(base_dir)
+    sys.path.insert(0, str(REPO_DIR))
+    import app as processor
+    from fastapi.staticfiles import StaticFiles
+
+    file_name = "bench.mp4"
+    file_size = args.size_mb * 1024 * 1024
+    with open(processor.STREAM_DIR / file_name, "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+
+    # The previous implementation, mounted next to the new routes
+    processor.app.mount("/legacy", StaticFiles(directory=str(processor.STREAM_DIR)), name="legacy")
+    server, thread = start_server(processor.app, args.port)
+
+    results = {
+        "file_size_mb": args.size_mb,
+        "concurrency": args.concurrency,
+        "range_kb": args.range_kb,
+        "duration_s": args.duration,
+        "implementations": {}
+    }
+    try:
+        for name, path in (("staticfiles", f"/legacy/{file_name}"), ("range_file_response", f"/stream/{file_name}")):
+            url = f"http://127.0.0.1:{args.port}{path}"
+            etag = asyncio.run(fetch_etag(url))
+            print(f"Benchmarking {name} ...")
+            results["implementations"][name] = {
+                # A player resuming a download sends If-Range so a changed file restarts from 0
+                "if_range_reads": asyncio.run(run_clients(
+                    url, file_size, args.concurrency, args.range_kb * 1024, args.duration, {"If-Range": etag}
+                )),
+                # Clients revalidating a file they already hold should get 304s
+                "revalidation": asyncio.run(run_clients(
+                    url, file_size, args.concurrency, 0, args.duration, {"If-None-Match": etag}
+                ))
+            }
+    finally:
+        server.should_exit = True
+        thread.join()
+        (processor.STREAM_DIR / file_name).unlink()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
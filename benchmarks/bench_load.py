@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+API load test with latency SLOs
+Replays a weighted mix of /process, /jobs/{id}, /files, /health and ranged
+/stream requests at a fixed request rate through one pooled aiohttp session,
+then reports latency percentiles, error rates and the server's event loop lag
+(from /metrics) per endpoint.
+
+Requests are sent on an open-loop schedule: latency is measured from when a
+request was due, so a server that falls behind shows it in the tail instead
+of silently lowering the offered rate.
+
+Without --url the app is started in-process against the fake tools in
+benchmarks/fake_tools. With --url an existing deployment is tested; note
+that /process traffic then submits real jobs for --process-url.
+Exits with status 1 when any SLO is missed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from common import latency_summary, start_server
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+FAKE_TOOLS = Path(__file__).resolve().parent / "fake_tools"
+DEFAULT_MIX = "process=5,job=30,files=15,health=20,stream=30"
+# Default SLOs, in the form endpoint:percentile=milliseconds
+DEFAULT_SLOS = (
+    "GET /health:p99=50",
+    "GET /jobs/{id}:p99=100",
+    "GET /files:p99=250",
+    "GET /stream/{file}:p99=250",
+    "POST /process:p99=250"
+)
+LOOP_LAG_METRIC = "processor_event_loop_lag_distribution_seconds"
+SAMPLE_FILE = "load_sample.mp4"
+SAMPLE_SIZE = 64 * 1024 * 1024
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def parse_slos(entries):
+    """'GET /health:p99=50' -> {("GET /health", "p99"): 50.0}"""
+    slos = {}
+    for entry in entries:
+        endpoint, _, target = entry.rpartition(":")
+        quantile, milliseconds = target.split("=")
+        slos[(endpoint, quantile)] = float(milliseconds)
+    return slos
+
+
+def parse_histogram(text, name):
+    """Cumulative bucket counts {le: count} and the sample count of a histogram in /metrics output."""
+    buckets = {}
+    count = 0
+    for line in text.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            bound = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets[float(bound)] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_count"):
+            count = float(line.rsplit(" ", 1)[1])
+    return buckets, count
+
+
+def histogram_quantile(before, after, quantile):
+    """Upper bucket bound holding `quantile` of the samples taken between two scrapes."""
+    bounds = sorted(after[0])
+    total = after[1] - before[1]
+    if total <= 0:
+        return None
+    for bound in bounds:
+        if after[0][bound] - before[0].get(bound, 0) >= quantile * total:
+            return bound
+    return float("inf")
+
+
+class LoadGenerator:
+    """Fires requests on schedule and records their outcome per endpoint."""
+
+    def __init__(self, session, base_url, args):
+        self.session = session
+        self.base_url = base_url
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.results = {}
+        self.inflight = 0
+        self.dropped = 0
+        self.job_ids = []
+        self.stream_file = None
+        self.stream_size = 0
+        self.submitted = 0
+
+    def record(self, endpoint, latency, status):
+        entry = self.results.setdefault(endpoint, {"latencies": [], "statuses": {}})
+        entry["latencies"].append(latency)
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+    def build_request(self, kind):
+        """(endpoint label, method, path, keyword arguments) for one request of `kind`."""
+        if kind == "process":
+            self.submitted += 1
+            return "POST /process", "POST", "/process", {"json": {
+                "url": self.args.process_url,
+                "save_name": f"load_{os.getpid()}_{self.submitted}",
+                "keys": ["00112233445566778899aabbccddeeff:00112233445566778899aabbccddeeff"],
+                "force": True
+            }}
+        if kind == "job" and self.job_ids:
+            job_id = self.random.choice(self.job_ids)
+            return "GET /jobs/{id}", "GET", f"/jobs/{job_id}", {}
+        if kind == "files":
+            return "GET /files", "GET", "/files", {}
+        if kind == "stream" and self.stream_file:
+            start = self.random.randrange(0, max(1, self.stream_size - self.args.range_bytes))
+            end = min(self.stream_size, start + self.args.range_bytes) - 1
+            return "GET /stream/{file}", "GET", f"/stream/{self.stream_file}", {
+                "headers": {"Range": f"bytes={start}-{end}"}
+            }
+        return "GET /health", "GET", "/health", {}
+
+    async def fire(self, kind, due):
+        endpoint, method, path, options = self.build_request(kind)
+        self.inflight += 1
+        try:
+            async with self.session.request(method, self.base_url + path, **options) as response:
+                body = await response.read()
+                status = response.status
+            if endpoint == "POST /process" and status == 200:
+                self.job_ids.append(json.loads(body)["job_id"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            status = type(error).__name__
+        finally:
+            self.inflight -= 1
+        self.record(endpoint, time.monotonic() - due, status)
+
+    async def run(self, weights):
+        kinds = list(weights)
+        cumulative = [sum(list(weights.values())[:index + 1]) for index in range(len(kinds))]
+        interval = 1 / self.args.rps
+        tasks = set()
+        started = time.monotonic()
+        sent = 0
+        # Client-side loop lag tells whether the generator itself kept up
+        client_lag = []
+        while True:
+            due = started + sent * interval
+            now = time.monotonic()
+            if due - started >= self.args.duration:
+                break
+            if due > now:
+                await asyncio.sleep(due - now)
+                client_lag.append(max(0.0, time.monotonic() - due))
+            sent += 1
+            if self.inflight >= self.args.max_inflight:
+                self.dropped += 1
+                continue
+            pick = self.random.uniform(0, cumulative[-1])
+            kind = next(kind for kind, bound in zip(kinds, cumulative) if pick <= bound)
+            task = asyncio.create_task(self.fire(kind, due))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.args.drain_timeout)
+        return time.monotonic() - started, sent, client_lag
+
+
+async def pick_stream_file(session, base_url):
+    """Largest file the server lists, for the ranged /stream traffic."""
+    async with session.get(f"{base_url}/files") as response:
+        files = (await response.json()).get("files", [])
+    if not files:
+        return None, 0
+    chosen = max(files, key=lambda entry: entry["size_mb"])
+    async with session.head(f"{base_url}/stream/{chosen['filename']}") as response:
+        return chosen["filename"], int(response.headers["Content-Length"])
+
+
+async def scrape_loop_lag(session, base_url):
+    try:
+        async with session.get(f"{base_url}/metrics") as response:
+            return parse_histogram(await response.text(), LOOP_LAG_METRIC)
+    except aiohttp.ClientError:
+        return {}, 0
+
+
+async def run_load(base_url, args):
+    weights = parse_mix(args.mix)
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        generator = LoadGenerator(session, base_url, args)
+        generator.stream_file, generator.stream_size = await pick_stream_file(session, base_url)
+        if generator.stream_file is None and weights.get("stream"):
+            print("No files to stream, /stream traffic falls back to /health", file=sys.stderr)
+
+        # Seed some jobs so /jobs/{id} has something to look up from the start
+        for _ in range(5):
+            await generator.fire("process", time.monotonic())
+        generator.results.clear()
+
+        lag_before = await scrape_loop_lag(session, base_url)
+        elapsed, sent, client_lag = await generator.run(weights)
+        lag_after = await scrape_loop_lag(session, base_url)
+
+    endpoints = {}
+    total_requests = total_errors = 0
+    for endpoint, entry in sorted(generator.results.items()):
+        errors = sum(count for status, count in entry["statuses"].items()
+                     if not isinstance(status, int) or status >= 400)
+        total_requests += len(entry["latencies"])
+        total_errors += errors
+        endpoints[endpoint] = {
+            "requests": len(entry["latencies"]),
+            "error_rate": round(errors / len(entry["latencies"]), 4),
+            "statuses": {str(status): count for status, count in sorted(entry["statuses"].items(), key=str)},
+            "latency_ms": latency_summary(entry["latencies"])
+        }
+
+    server_lag = {}
+    if lag_after[1]:
+        for name, quantile in (("p50", 0.5), ("p99", 0.99)):
+            bound = histogram_quantile(lag_before, lag_after, quantile)
+            server_lag[name] = None if bound is None else round(bound * 1000, 1)
+        server_lag["samples"] = int(lag_after[1] - lag_before[1])
+
+    return {
+        "target_rps": args.rps,
+        "achieved_rps": round(total_requests / elapsed, 1),
+        "sent": sent,
+        "dropped": generator.dropped,
+        "error_rate": round(total_errors / total_requests, 4) if total_requests else None,
+        "endpoints": endpoints,
+        # Histogram bucket bounds, so these are upper limits
+        "server_loop_lag_ms": server_lag,
+        "client_loop_lag_ms": latency_summary(client_lag)
+    }
+
+
+def check_slos(results, args):
+    """List of SLO violations in the results."""
+    violations = []
+    for (endpoint, quantile), limit in parse_slos(args.slo or DEFAULT_SLOS).items():
+        value = results["endpoints"].get(endpoint, {}).get("latency_ms", {}).get(quantile)
+        if value is not None and value > limit:
+            violations.append(f"{endpoint} {quantile} {value} ms > {limit} ms")
+    if results["error_rate"] is not None and results["error_rate"] > args.max_error_rate:
+        violations.append(f"error rate {results['error_rate']} > {args.max_error_rate}")
+    lag = results["server_loop_lag_ms"].get("p99")
+    if lag is not None and lag > args.max_loop_lag_ms:
+        violations.append(f"server event loop lag p99 {lag} ms > {args.max_loop_lag_ms} ms")
+    if results["dropped"] > args.max_dropped_rate * results["sent"]:
+        violations.append(f"{results['dropped']} requests dropped at --max-inflight {args.max_inflight}")
+    return violations
+
+
+def start_local_app(args):
+    """Start the app in-process with the fake tools and a file to stream."""
+    base_dir = Path(tempfile.mkdtemp(prefix="bench_load_"))
+    (base_dir / "stream").mkdir()
+    with open(base_dir / "stream" / SAMPLE_FILE, "wb") as sample:
+        sample.write(os.urandom(SAMPLE_SIZE))
+    os.environ.update({
+        "APP_BASE_DIR": str(base_dir),
+        "N_M3U8DL_RE_PATH": str(FAKE_TOOLS / "fake_n_m3u8dl_re.py"),
+        "FFMPEG_PATH": str(FAKE_TOOLS / "fake_ffmpeg.py"),
+        "FFPROBE_PATH": str(FAKE_TOOLS / "fake_ffprobe.py"),
+        "FAKE_DOWNLOAD_MB": os.environ.get("FAKE_DOWNLOAD_MB", "5"),
+        "FAKE_DOWNLOAD_MB_PER_S": os.environ.get("FAKE_DOWNLOAD_MB_PER_S", "20"),
+        "GDRIVE_UPLOAD": "0",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING")
+    })
+    sys.path.insert(0, str(REPO_DIR))
+    import app as processor
+
+    return start_server(processor.app, args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running server (default: start the app locally)")
+    parser.add_argument("--rps", type=float, default=50.0, help="Target request rate")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weights per request kind: process, job, files, health, stream")
+    parser.add_argument("--connections", type=int, default=32, help="Connection pool size")
+    parser.add_argument("--max-inflight", type=int, default=256, help="Requests beyond this are dropped and counted")
+    parser.add_argument("--range-bytes", type=int, default=1024 * 1024, help="Size of each /stream range read")
+    parser.add_argument("--process-url", default="https://cdn.load.example/manifest.mpd",
+                        help="Manifest URL sent with /process")
+    parser.add_argument("--request-timeout", type=float, default=30.0)
+    parser.add_argument("--drain-timeout", type=float, default=30.0, help="Wait for outstanding requests at the end")
+    parser.add_argument("--slo", action="append", help="endpoint:pN=ms, repeatable (default: %s)" % ", ".join(DEFAULT_SLOS))
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--max-loop-lag-ms", type=float, default=100.0, help="Limit for the server's loop lag p99")
+    parser.add_argument("--max-dropped-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8768)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url.rstrip("/") if args.url else f"http://127.0.0.1:{args.port}"
+    if not args.url:
+        server, thread = start_local_app(args)
+    try:
+        results = asyncio.run(run_load(base_url, args))
+    finally:
+        if server:
+            server.should_exit = True
+            thread.join(timeout=10)
+
+    results["slo_violations"] = check_slos(results, args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if results["slo_violations"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Orchestration benchmark for the job pipeline
+Runs the real app against the fake N_m3u8DL-RE/ffmpeg/ffprobe in
+benchmarks/fake_tools and measures scheduler overhead, API latency with
+1k queued jobs, memory per queued job and end-to-end throughput.
+
+Each scenario runs in its own process (fresh app state, clean memory figures).
+Use --save-baseline to record results and --compare to check a run against
+them; a regression beyond --tolerance exits with status 1.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from common import latency_summary, start_server
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+FAKE_TOOLS = Path(__file__).resolve().parent / "fake_tools"
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines" / "orchestration.json"
+
+# Environment per scenario, on top of the fake tool paths
+SCENARIOS = {
+    # Near-instant tools: what's left of a job's time is our own orchestration
+    "scheduler": {
+        "FAKE_DOWNLOAD_MB": "0.01", "FAKE_DOWNLOAD_MB_PER_S": "0", "FAKE_STARTUP_SECONDS": "0",
+        "FAKE_REMUX_MB_PER_S": "0", "MAX_CONCURRENT_JOBS": "8", "MAX_JOBS_PER_HOST": "8"
+    },
+    # One slow running job, everything else stays queued
+    "api_latency": {
+        "FAKE_DOWNLOAD_MB": "60", "FAKE_DOWNLOAD_MB_PER_S": "1",
+        "MAX_CONCURRENT_JOBS": "1", "MAX_JOBS_PER_HOST": "1"
+    },
+    # Realistic sizes and rates with some failing downloads
+    "throughput": {
+        "FAKE_DOWNLOAD_MB": "20", "FAKE_DOWNLOAD_MB_PER_S": "100", "FAKE_REMUX_MB_PER_S": "400",
+        "FAKE_FAIL_RATE": "0.05", "MAX_CONCURRENT_JOBS": "4", "MAX_JOBS_PER_HOST": "2"
+    }
+}
+
+# Figures compared against the baseline, and which direction is better
+TRACKED = {
+    "scheduler.jobs_per_s": "higher",
+    "scheduler.overhead_ms.p50": "lower",
+    "scheduler.overhead_ms.p95": "lower",
+    "api_latency.memory.bytes_per_queued_job": "lower",
+    "api_latency.endpoints.GET /jobs/{id}.p95": "lower",
+    "api_latency.endpoints.POST /jobs/status.p95": "lower",
+    "api_latency.endpoints.POST /process.p95": "lower",
+    "api_latency.endpoints.GET /metrics.p95": "lower",
+    "throughput.mb_per_s": "higher",
+    "throughput.efficiency": "higher"
+}
+
+
+def job_payload(index, hosts):
+    return {
+        "url": f"https://cdn{index % hosts}.bench.example/{index}/manifest.mpd",
+        "save_name": f"bench_{index}",
+        "keys": ["00112233445566778899aabbccddeeff:00112233445566778899aabbccddeeff"],
+        "force": True
+    }
+
+
+def rss_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def submit_jobs(session, base_url, count, hosts, start=0):
+    """Submit `count` jobs through /process/batch and return their ids."""
+    job_ids = []
+    for offset in range(0, count, 500):
+        jobs = [job_payload(start + index, hosts) for index in range(offset, min(count, offset + 500))]
+        async with session.post(f"{base_url}/process/batch", json={"jobs": jobs}) as response:
+            body = await response.json()
+            job_ids.extend(body["job_ids"])
+    return job_ids
+
+
+async def wait_for_jobs(processor, job_ids, timeout):
+    """Wait until every job reached a final status."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pending = [
+            job_id for job_id in job_ids
+            if (processor.active_jobs.get(job_id) or processor.completed_jobs.get(job_id) or {}).get("status")
+            not in processor.FINISHED_STATUSES
+        ]
+        if not pending:
+            return
+        await asyncio.sleep(0.1)
+    raise TimeoutError(f"{len(pending)} jobs still running after {timeout}s")
+
+
+def job_record(processor, job_id):
+    return processor.completed_jobs.get(job_id) or processor.active_jobs.get(job_id)
+
+
+async def measure_endpoint(session, make_request, requests, concurrency):
+    """Latency of `requests` calls issued by `concurrency` workers."""
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, kwargs = make_request()
+            began = time.monotonic()
+            async with session.request(method, url, **kwargs) as response:
+                await response.read()
+                if response.status >= 400:
+                    errors += 1
+            latencies.append(time.monotonic() - began)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {**latency_summary(latencies), "requests": len(latencies), "errors": errors}
+
+
+async def scenario_scheduler(processor, base_url, args):
+    jobs = max(1, args.jobs // 4)
+    async with aiohttp.ClientSession() as session:
+        started = time.monotonic()
+        job_ids = await submit_jobs(session, base_url, jobs, hosts=16)
+        await wait_for_jobs(processor, job_ids, timeout=600)
+        elapsed = time.monotonic() - started
+
+    # Whatever a running job spent outside its child processes is orchestration overhead
+    overheads = []
+    for job_id in job_ids:
+        job = job_record(processor, job_id)
+        children = (job.get("resources") or {}).get("total", {}).get("wall_seconds", 0)
+        queued = job["timings"]["stages"]["queue"]["seconds"]
+        overheads.append(max(0.0, job["timings"]["total_seconds"] - queued - children))
+    return {
+        "jobs": len(job_ids),
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_s": round(len(job_ids) / elapsed, 1),
+        "overhead_ms": latency_summary(overheads)
+    }
+
+
+async def scenario_api_latency(processor, base_url, args):
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        gc.collect()
+        rss_before = rss_bytes()
+        job_ids = await submit_jobs(session, base_url, args.jobs, hosts=16)
+        gc.collect()
+        rss_after = rss_bytes()
+
+        async with session.get(f"{base_url}/jobs") as response:
+            jobs_etag = response.headers.get("ETag", "")
+        submitted = iter(range(args.jobs, args.jobs * 10))
+
+        endpoints = {
+            "GET /jobs/{id}": lambda: ("GET", f"{base_url}/jobs/{random.choice(job_ids)}", {}),
+            "GET /jobs": lambda: ("GET", f"{base_url}/jobs", {}),
+            "GET /jobs (If-None-Match)": lambda: ("GET", f"{base_url}/jobs", {"headers": {"If-None-Match": jobs_etag}}),
+            "POST /jobs/status": lambda: ("POST", f"{base_url}/jobs/status", {
+                "json": {"job_ids": random.sample(job_ids, 100), "fields": ["status", "revision"]}
+            }),
+            "GET /metrics": lambda: ("GET", f"{base_url}/metrics", {}),
+            "GET /stats": lambda: ("GET", f"{base_url}/stats", {}),
+            "POST /process": lambda: ("POST", f"{base_url}/process", {"json": job_payload(next(submitted), 16)})
+        }
+        results = {}
+        for name, make_request in endpoints.items():
+            results[name] = await measure_endpoint(session, make_request, args.requests, args.concurrency)
+
+    return {
+        "queued_jobs": len(processor.queued_requests),
+        "memory": {
+            "rss_before_mb": round(rss_before / 1048576, 1),
+            "rss_after_mb": round(rss_after / 1048576, 1),
+            "bytes_per_queued_job": round((rss_after - rss_before) / len(job_ids))
+        },
+        "endpoints": results
+    }
+
+
+async def scenario_throughput(processor, base_url, args):
+    jobs = max(1, args.jobs // 10)
+    async with aiohttp.ClientSession() as session:
+        started = time.monotonic()
+        job_ids = await submit_jobs(session, base_url, jobs, hosts=8)
+        await wait_for_jobs(processor, job_ids, timeout=1800)
+        elapsed = time.monotonic() - started
+
+    records = [job_record(processor, job_id) for job_id in job_ids]
+    completed = [job for job in records if job["status"] == "completed"]
+    downloaded = sum((job.get("download_stats") or {}).get("bytes", 0) for job in completed)
+    mb_per_s = downloaded / 1048576 / elapsed
+    download_rate = float(os.environ["FAKE_DOWNLOAD_MB_PER_S"])
+    return {
+        "jobs": jobs,
+        "completed": len(completed),
+        "failed": len(records) - len(completed),
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_s": round(len(completed) / elapsed, 2),
+        "mb_per_s": round(mb_per_s, 1),
+        # Share of the fake tools' aggregate download rate that the pipeline achieved
+        "efficiency": round(mb_per_s / (download_rate * processor.MAX_CONCURRENT_JOBS), 3),
+        "stages": {stage: window.summary() for stage, window in processor.stage_windows.items()}
+    }
+
+
+def run_scenario(args):
+    """Worker process: start the app with the fake tools and run one scenario."""
+    sys.path.insert(0, str(REPO_DIR))
+    import app as processor
+
+    server, thread = start_server(processor.app, args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+    scenario = {
+        "scheduler": scenario_scheduler,
+        "api_latency": scenario_api_latency,
+        "throughput": scenario_throughput
+    }[args.run_scenario]
+    try:
+        result = asyncio.run(scenario(processor, base_url, args))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+    print(json.dumps(result))
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """Return (metric, baseline, current, change) for every tracked metric that got worse than allowed."""
+    current = flatten(results["scenarios"])
+    reference = flatten(baseline["scenarios"])
+    regressions = []
+    for metric, better in TRACKED.items():
+        if metric not in current or not reference.get(metric):
+            continue
+        change = (current[metric] - reference[metric]) / reference[metric]
+        if (better == "lower" and change > tolerance) or (better == "higher" and change < -tolerance):
+            regressions.append((metric, reference[metric], current[metric], round(change * 100, 1)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--jobs", type=int, default=1000, help="Queued jobs for api_latency (scheduler runs a quarter, throughput a tenth)")
+    parser.add_argument("--requests", type=int, default=300, help="Requests per endpoint in api_latency")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients in api_latency")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--save-baseline", nargs="?", const=str(DEFAULT_BASELINE), help="Store results as the baseline")
+    parser.add_argument("--compare", nargs="?", const=str(DEFAULT_BASELINE), help="Compare against a baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed relative regression (0.3 = 30%%)")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        run_scenario(args)
+        return
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"cpus": os.cpu_count(), "python": sys.version.split()[0]},
+        "parameters": {"jobs": args.jobs, "requests": args.requests, "concurrency": args.concurrency},
+        "scenarios": {}
+    }
+    for name in args.scenarios.split(","):
+        base_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+        env = {
+            **os.environ,
+            **SCENARIOS[name],
+            "APP_BASE_DIR": base_dir,
+            "N_M3U8DL_RE_PATH": str(FAKE_TOOLS / "fake_n_m3u8dl_re.py"),
+            "FFMPEG_PATH": str(FAKE_TOOLS / "fake_ffmpeg.py"),
+            "FFPROBE_PATH": str(FAKE_TOOLS / "fake_ffprobe.py"),
+            "GDRIVE_UPLOAD": "0",
+            "LOG_LEVEL": "WARNING",
+            "MAX_BATCH_SIZE": "1000"
+        }
+        print(f"Running {name} ...", file=sys.stderr)
+        # Own session, so fake tools still running at the end can be killed with the worker
+        worker = subprocess.Popen(
+            [sys.executable, __file__, "--run-scenario", name, "--jobs", str(args.jobs),
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--port", str(args.port)],
+            env=env, stdout=subprocess.PIPE, start_new_session=True
+        )
+        stdout, _ = worker.communicate()
+        try:
+            os.killpg(worker.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        shutil.rmtree(base_dir, ignore_errors=True)
+        if worker.returncode != 0:
+            sys.exit(f"Scenario {name} failed with exit code {worker.returncode}")
+        results["scenarios"][name] = json.loads(stdout.decode().strip().splitlines()[-1])
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=2) + "\n")
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for metric, before, after, change in regressions:
+            print(f"REGRESSION {metric}: {before} -> {after} ({change:+}%)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
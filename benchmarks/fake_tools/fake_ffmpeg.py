@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Stand-in for ffmpeg used by the benchmarks
+Copies the -i input to the output path (the last argument) at a configurable
+rate, printing ffmpeg-style progress to stderr. Outputs with a % pattern
+(image sequences) are accepted and skipped.
+
+Environment:
+  FAKE_REMUX_MB_PER_S       Copy rate, 0 for as fast as possible (default 400)
+  FAKE_REMUX_FAIL_RATE      Probability of exiting with code 1 (default 0)
+"""
+
+import os
+import random
+import sys
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def main():
+    args = sys.argv[1:]
+    if "-version" in args:
+        print("ffmpeg version 0.0.0-fake")
+        return 0
+    if random.random() < float(os.environ.get("FAKE_REMUX_FAIL_RATE", "0")):
+        sys.stderr.write("Error while processing the decoded data\n")
+        return 1
+    if "-i" not in args or "%" in args[-1]:
+        return 0
+
+    source = args[args.index("-i") + 1]
+    target = args[-1]
+    rate = float(os.environ.get("FAKE_REMUX_MB_PER_S", "400")) * 1024 * 1024
+    size = os.path.getsize(source)
+    started = time.monotonic()
+    copied = 0
+    frame = 0
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        while chunk := src.read(CHUNK_SIZE):
+            dst.write(chunk)
+            copied += len(chunk)
+            frame += 25
+            elapsed = time.monotonic() - started
+            if rate > 0 and copied / rate > elapsed:
+                time.sleep(copied / rate - elapsed)
+            sys.stderr.write(
+                f"frame={frame:5d} fps=0.0 q=-1.0 size={copied // 1024:8d}kB "
+                f"time=00:00:{frame / 25 % 60:05.2f} bitrate=4500.0kbits/s speed=50x\r"
+            )
+    sys.stderr.write(f"\nvideo:{size // 1024}kB audio:0kB subtitle:0kB other streams:0kB muxing overhead: 0.1%\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
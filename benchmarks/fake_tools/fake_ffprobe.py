@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""Stand-in for ffprobe used by the benchmarks: reports one H.264 and one AAC stream."""
+
+import json
+import os
+import sys
+
+size = os.path.getsize(sys.argv[-1]) if len(sys.argv) > 1 and os.path.exists(sys.argv[-1]) else 0
+json.dump({
+    "streams": [
+        {"index": 0, "codec_type": "video", "codec_name": "h264", "profile": "High", "width": 1920,
+         "height": 1080, "avg_frame_rate": "25/1", "bit_rate": "4500000"},
+        {"index": 1, "codec_type": "audio", "codec_name": "aac", "channels": 2, "sample_rate": "48000",
+         "bit_rate": "128000", "tags": {"language": "eng"}}
+    ],
+    "format": {"format_name": "mov,mp4,m4a,3gp,3g2,mj2", "duration": str(size * 8 / 4628000),
+               "bit_rate": "4628000"}
+}, sys.stdout)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Stand-in for N_m3u8DL-RE used by the benchmarks
+Writes <save-name>.<format> into the working directory at a configurable rate,
+printing progress lines shaped like the real tool's.
+
+Environment:
+  FAKE_DOWNLOAD_MB          Output size in MB (default 50)
+  FAKE_DOWNLOAD_MB_PER_S    Write rate, 0 for as fast as possible (default 100)
+  FAKE_STARTUP_SECONDS      Simulated manifest/key fetch before the download (default 0.05)
+  FAKE_FAIL_RATE            Probability of failing half-way with exit code 1 (default 0)
+  FAKE_PROGRESS_INTERVAL    Seconds between progress lines (default 0.5)
+"""
+
+import os
+import random
+import sys
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def option(args, name, default=None):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return default
+
+
+def main():
+    args = sys.argv[1:]
+    if "--version" in args:
+        print("N_m3u8DL-RE (fake) 0.0.0")
+        return 0
+
+    save_name = option(args, "--save-name", "output")
+    mux = option(args, "-M", "format=mkv")
+    extension = dict(part.split("=", 1) for part in mux.split(":") if "=" in part).get("format", "mkv")
+
+    size = int(float(os.environ.get("FAKE_DOWNLOAD_MB", "50")) * 1024 * 1024)
+    rate = float(os.environ.get("FAKE_DOWNLOAD_MB_PER_S", "100")) * 1024 * 1024
+    fail_rate = float(os.environ.get("FAKE_FAIL_RATE", "0"))
+    progress_interval = float(os.environ.get("FAKE_PROGRESS_INTERVAL", "0.5"))
+    fail_at = size // 2 if random.random() < fail_rate else None
+
+    time.sleep(float(os.environ.get("FAKE_STARTUP_SECONDS", "0.05")))
+    print(f"{time.strftime('%H:%M:%S')}.000 INFO : Extracted, there are 1 streams, with 1 basic streams")
+    print(f"{time.strftime('%H:%M:%S')}.000 INFO : Start downloading...Vid 1920x1080 | 4500 Kbps")
+    sys.stdout.flush()
+
+    segments = max(1, size // (2 * CHUNK_SIZE))
+    block = os.urandom(CHUNK_SIZE)
+    started = time.monotonic()
+    last_progress = 0.0
+    written = 0
+    with open(f"{save_name}.{extension}", "wb") as output:
+        while written < size:
+            if fail_at is not None and written >= fail_at:
+                print(f"{time.strftime('%H:%M:%S')}.000 ERROR: Segment download failed after 3 retries")
+                return 1
+            count = min(CHUNK_SIZE, size - written)
+            output.write(block[:count])
+            written += count
+
+            elapsed = time.monotonic() - started
+            if rate > 0 and written / rate > elapsed:
+                time.sleep(written / rate - elapsed)
+                elapsed = time.monotonic() - started
+            if elapsed - last_progress >= progress_interval or written == size:
+                last_progress = elapsed
+                done = written * segments // size
+                speed = written / max(elapsed, 1e-6) / (1024 * 1024)
+                print(
+                    f"Vid 1920x1080 | 4500 Kbps {'━' * 30} {done}/{segments} {written * 100 / size:.2f}% "
+                    f"{written / 1048576:.2f}MB/{size / 1048576:.2f}MB {speed:.2f}MBps "
+                    f"{time.strftime('%H:%M:%S', time.gmtime(max(0, (size - written) / max(speed * 1048576, 1))))}"
+                )
+                sys.stdout.flush()
+
+    print(f"{time.strftime('%H:%M:%S')}.000 INFO : Done")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Synthetic HLS/DASH origin for end-to-end tests
+Generates clear (unencrypted) test content with ffmpeg and serves it over
+localhost with tunable latency, bandwidth and error injection.
+
+  /hls/index.m3u8      HLS (MPEG-TS segments)
+  /dash/manifest.mpd   DASH (fMP4 segments, SegmentTemplate)
+  /_stats              Requests served, bytes sent and errors injected
+
+Content is cached per (duration, bitrate, resolution, segment length) under
+--cache-dir, so repeated runs only pay for the encode once.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+DEFAULT_CACHE_DIR = Path("/tmp/synthetic_origin")
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".mpd": "application/dash+xml",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4"
+}
+
+
+def generate_content(cache_dir, ffmpeg="ffmpeg", duration=60.0, bitrate_kbps=3000,
+                     resolution="1280x720", segment_seconds=4.0):
+    """Encode a test pattern once and package it as HLS and DASH; returns the content directory."""
+    key = hashlib.sha256(json.dumps([duration, bitrate_kbps, resolution, segment_seconds]).encode()).hexdigest()[:12]
+    content_dir = Path(cache_dir) / key
+    if (content_dir / "ready").exists():
+        return content_dir
+
+    (content_dir / "hls").mkdir(parents=True, exist_ok=True)
+    (content_dir / "dash").mkdir(parents=True, exist_ok=True)
+    source = content_dir / "source.mp4"
+    keyframe_interval = str(int(segment_seconds * 25))
+
+    # Constant keyframe spacing so every segment starts on a keyframe
+    subprocess.run([
+        ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=25",
+        "-f", "lavfi", "-i", "sine=frequency=1000:sample_rate=48000",
+        "-t", str(duration),
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{bitrate_kbps}k",
+        "-maxrate", f"{bitrate_kbps}k", "-bufsize", f"{bitrate_kbps * 2}k",
+        "-g", keyframe_interval, "-keyint_min", keyframe_interval, "-sc_threshold", "0",
+        "-c:a", "aac", "-b:a", "128k", "-metadata:s:a:0", "language=eng",
+        str(source)
+    ], check=True)
+    subprocess.run([
+        ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-i", str(source), "-c", "copy",
+        "-f", "hls", "-hls_time", str(segment_seconds), "-hls_playlist_type", "vod",
+        "-hls_segment_filename", str(content_dir / "hls" / "segment_%05d.ts"),
+        str(content_dir / "hls" / "index.m3u8")
+    ], check=True)
+    subprocess.run([
+        ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-i", str(source), "-c", "copy",
+        "-f", "dash", "-seg_duration", str(segment_seconds), "-use_template", "1", "-use_timeline", "0",
+        "-init_seg_name", "init-$RepresentationID$.m4s",
+        "-media_seg_name", "chunk-$RepresentationID$-$Number%05d$.m4s",
+        str(content_dir / "dash" / "manifest.mpd")
+    ], check=True)
+    (content_dir / "ready").write_text(json.dumps({
+        "duration": duration, "bitrate_kbps": bitrate_kbps,
+        "resolution": resolution, "segment_seconds": segment_seconds
+    }))
+    return content_dir
+
+
+class Impairments:
+    """Latency, bandwidth and error injection applied to each request."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, bandwidth_mbps=0.0, error_rate=0.0,
+                 error_mode="503", errors_on="segments", seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.bandwidth_mbps = bandwidth_mbps  # Per connection, 0 = unlimited
+        self.error_rate = error_rate
+        self.error_mode = error_mode  # "503", "404", "reset" or "truncate"
+        self.errors_on = errors_on  # "segments" or "all"
+        self.random = random.Random(seed)
+
+    def should_fail(self, path: str) -> bool:
+        is_manifest = path.endswith((".m3u8", ".mpd"))
+        if self.errors_on == "segments" and is_manifest:
+            return False
+        return self.random.random() < self.error_rate
+
+
+def build_app(content_dir: Path, impairments: Impairments) -> web.Application:
+    stats = {"requests": 0, "bytes_sent": 0, "errors_injected": 0, "status_codes": {}}
+
+    async def serve(request: web.Request) -> web.StreamResponse:
+        relative = request.match_info["path"]
+        root = (content_dir / request.match_info["kind"]).resolve()
+        path = (root / relative).resolve()
+        if root not in path.parents or not path.is_file():
+            raise web.HTTPNotFound()
+        stats["requests"] += 1
+
+        delay = impairments.latency_ms + impairments.random.uniform(0, impairments.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        failing = impairments.should_fail(relative)
+        if failing:
+            stats["errors_injected"] += 1
+            if impairments.error_mode in ("503", "404"):
+                status = int(impairments.error_mode)
+                stats["status_codes"][status] = stats["status_codes"].get(status, 0) + 1
+                return web.Response(status=status, text="injected error")
+            if impairments.error_mode == "reset":
+                request.transport.close()
+                return web.Response(status=500)
+
+        data = path.read_bytes()
+        response = web.StreamResponse(headers={
+            "Content-Type": CONTENT_TYPES.get(path.suffix, "application/octet-stream"),
+            "Content-Length": str(len(data))
+        })
+        await response.prepare(request)
+        stats["status_codes"][200] = stats["status_codes"].get(200, 0) + 1
+
+        # Truncated responses stop half-way and drop the connection
+        end = len(data) // 2 if failing else len(data)
+        chunk_size = 64 * 1024
+        bytes_per_second = impairments.bandwidth_mbps * 1_000_000 / 8
+        started = time.monotonic()
+        for offset in range(0, end, chunk_size):
+            chunk = data[offset:min(end, offset + chunk_size)]
+            await response.write(chunk)
+            stats["bytes_sent"] += len(chunk)
+            if bytes_per_second > 0:
+                ahead = (offset + len(chunk)) / bytes_per_second - (time.monotonic() - started)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        if failing:
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get("/_stats", get_stats)
+    app.router.add_get("/{kind:hls|dash}/{path:.+}", serve)
+    app["stats"] = stats
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument("--duration", type=float, default=60.0, help="Content duration in seconds")
+    parser.add_argument("--segments", type=int, help="Segment count (overrides --duration)")
+    parser.add_argument("--segment-seconds", type=float, default=4.0)
+    parser.add_argument("--bitrate-kbps", type=int, default=3000, help="Video bitrate")
+    parser.add_argument("--resolution", default="1280x720")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added delay per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random extra delay per request (uniform)")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0, help="Per-connection rate limit, 0 = none")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of an injected error per request")
+    parser.add_argument("--error-mode", choices=["503", "404", "reset", "truncate"], default="503")
+    parser.add_argument("--errors-on", choices=["segments", "all"], default="segments")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for jitter and error injection")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR))
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+
+
+def prepare(args):
+    """Generate (or reuse) content and build the origin app from parsed arguments."""
+    duration = args.segments * args.segment_seconds if args.segments else args.duration
+    content_dir = generate_content(args.cache_dir, args.ffmpeg, duration, args.bitrate_kbps,
+                                   args.resolution, args.segment_seconds)
+    impairments = Impairments(args.latency_ms, args.jitter_ms, args.bandwidth_mbps, args.error_rate,
+                              args.error_mode, args.errors_on, args.seed)
+    return build_app(content_dir, impairments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args()
+
+    app = prepare(args)
+    print(f"Serving http://127.0.0.1:{args.port}/hls/index.m3u8 and /dash/manifest.mpd", file=sys.stderr)
+    web.run_app(app, host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()